@@ -1,28 +1,118 @@
 from fastapi import UploadFile
 from db_op import DB
+from sqlalchemy.ext.asyncio import AsyncSession
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
+import time
 import bcrypt
-import base64
+import config
+
+
+# module level so they can be pickled into a process pool
+def hashpw(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+
+
+def checkpw(plain_password: str, hashed_password: str) -> bool:
+    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+class HashPoolFull(Exception):
+    pass
+
+
+class HashPool:
+    def __init__(self, kind: str, workers: int, max_concurrency: int, max_queue: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.executor = None
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def get_executor(self):
+        # created lazily so importing the module does not fork worker processes
+        if self.executor is None:
+            if self.kind == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self.executor
+
+    async def run(self, fn, *args):
+        if self.max_queue and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HashPoolFull("too many pending password checks, try again")
+
+        queued_at = time.perf_counter()
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        started_at = time.perf_counter()
+        self.wait_seconds += started_at - queued_at
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.get_executor(), fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self.run_seconds += time.perf_counter() - started_at
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        done = self.completed or 1
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_seconds / done * 1000, 3),
+            "avg_run_ms": round(self.run_seconds / done * 1000, 3),
+        }
+
 
 class Authent:
+    hash_pool = HashPool(
+        config.HASH_POOL_KIND,
+        config.HASH_POOL_WORKERS,
+        config.HASH_MAX_CONCURRENCY,
+        config.HASH_MAX_QUEUE)
+
     def hash_password(password):
-        pwd_bytes = password.encode('utf-8')
-        gen_salt = bcrypt.gensalt()
-        return bcrypt.hashpw(pwd_bytes, gen_salt)
+        return hashpw(password)
 
     def verify_password(plain_password, hashed_password):
-        pwd_bytes = plain_password.encode('utf-8')
-        hashed_bytes = hashed_password.encode('utf-8')
-        return bcrypt.checkpw(pwd_bytes, hashed_bytes)
+        return checkpw(plain_password, hashed_password)
+
+    async def hash_password_async(password: str) -> bytes:
+        return await Authent.hash_pool.run(hashpw, password)
+
+    async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+        return await Authent.hash_pool.run(checkpw, plain_password, hashed_password)
 
-    def authenticate_user(db: DB, username: str, password: str):
-        user = db.get_user_by_email(username)
+    async def authenticate_user(db: DB, session: AsyncSession, username: str, password: str):
+        user = await db.get_user_by_email(session, username)
         if not user:
             return False
-        if not Authent.verify_password(password, user.password):
+        if not await Authent.verify_password_async(password, user.password):
             return False
         return user
 
-    async def authenticate_file(file: UploadFile, size, filetype: list = None) -> str:
+    async def authenticate_file(file: UploadFile, size, filetype: list = None) -> bytes:
         if file.size < 1 or file.size > size:
             raise Exception(f"file size have to atleast 1 KB to utmost {size / 1024}KB")
 
@@ -30,6 +120,4 @@ class Authent:
             ext = file.content_type.split('/')[1]
             if ext not in filetype:
                 raise Exception("invalid file type")
-        file_bytes = await file.read()
-        encode_image = base64.b64encode(file_bytes).decode("utf-8")
-        return encode_image
+        return await file.read()
@@ -1,14 +1,49 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Dict, Tuple
 from datetime import timedelta, datetime, timezone
+from collections import OrderedDict
+import time
 from jwt.exceptions import InvalidTokenError
 import jwt
-from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from db_op import DB
 from model import UserBase, ElderStatus, get_record_form
-from authenticate import Authent
-from institutions import captain_institutions
+import config
+
+
+class PrincipalCache:
+    """LRU of resolved users keyed by email (the token subject), entries expire after ttl seconds."""
+
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: Dict[str, Tuple[float, UserBase]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, email: str) -> Optional[UserBase]:
+        entry = self.entries.get(email)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[email]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(email)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, email: str, user: UserBase):
+        self.entries[email] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(email)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, email: str):
+        self.entries.pop(email, None)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
 
 
 class Autherize:
@@ -18,6 +53,7 @@ class Autherize:
     ACCESS_TOKEN_EXPIRE_DAY = 3
     TIME_GAP = timedelta(seconds=10)
     db: DB = None
+    principals = PrincipalCache(config.PRINCIPAL_CACHE_TTL, config.PRINCIPAL_CACHE_SIZE)
 
     @staticmethod
     def auth_exception(detail):
@@ -27,6 +63,13 @@ class Autherize:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+    # dep_session and dep_get_current_user are plain functions (no staticmethod) so the
+    # class body and the endpoints share one dependency key; FastAPI then resolves them
+    # once per request and hands every dependency the same session and user
+    async def dep_session():
+        async for session in Autherize.db.get_session():
+            yield session
+
     @staticmethod
     def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         to_encode = data.copy()
@@ -40,7 +83,17 @@ class Autherize:
         return encode_jwt
 
     @staticmethod
-    def dep_get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
+    async def get_principal(session: AsyncSession, email: str) -> Optional[UserBase]:
+        user = Autherize.principals.get(email)
+        if user is None:
+            user_db = await Autherize.db.get_user_by_email(session, email)
+            if user_db is None:
+                return None
+            user = Autherize.db.from_DBModel_to_responseModel(user_db)
+            Autherize.principals.put(email, user)
+        return user
+
+    async def dep_get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: Annotated[AsyncSession, Depends(dep_session)]):
         credentials_exception = Autherize.auth_exception("invalid credentials")
         try:
             payload = jwt.decode(token, Autherize.SECRET_KEY, algorithms=[Autherize.ALGORITHM])
@@ -49,10 +102,10 @@ class Autherize:
                 raise credentials_exception
         except InvalidTokenError:
             raise credentials_exception
-        user = Autherize.db.get_user_by_email(username)
+        user = await Autherize.get_principal(session, username)
         if user is None:
             raise credentials_exception
-        return Autherize.db.from_DBModel_to_responseModel(user)
+        return user
 
     @staticmethod
     def dep_only_elder(current_user: Annotated[UserBase, Depends(dep_get_current_user)]):
@@ -67,23 +120,22 @@ class Autherize:
         return current_user
 
     @staticmethod
-    def dep_no_service_assigned(current_user: Annotated[UserBase, Depends(dep_only_elder)]):
-        record = Autherize.db.get_elder_record_by_email(current_user.email, current_user.user_type)
+    async def dep_no_service_assigned(current_user: Annotated[UserBase, Depends(dep_only_elder)], session: Annotated[AsyncSession, Depends(dep_session)]):
+        record = await Autherize.db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
         if record.status != ElderStatus.not_assigned:
             raise Autherize.auth_exception("already_assigned")
         return record
 
     @staticmethod
-    def dep_searching_volunteer(current_user: Annotated[UserBase, Depends(dep_only_elder)]):
-        record = Autherize.db.get_elder_record_by_email(current_user.email, current_user.user_type)
+    async def dep_searching_volunteer(current_user: Annotated[UserBase, Depends(dep_only_elder)], session: Annotated[AsyncSession, Depends(dep_session)]):
+        record = await Autherize.db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
         if record.status != ElderStatus.searching_a_volunteer:
             raise Autherize.auth_exception("already assigned or not requested for searching")
         return (current_user, record)
 
     @staticmethod
-    def dep_update_record(record_form: Annotated[dict, Depends(get_record_form)], current_user: Annotated[UserBase, Depends(dep_only_volunteer)]):
-        record = Autherize.db.get_elder_record_by_email(current_user.email, current_user.user_type)
-        volunteer = Autherize.db.get_user_by_email(current_user.email)
+    async def dep_update_record(record_form: Annotated[dict, Depends(get_record_form)], current_user: Annotated[UserBase, Depends(dep_only_volunteer)], session: Annotated[AsyncSession, Depends(dep_session)]):
+        record = await Autherize.db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
 
         if record is None or record.status != ElderStatus.assigned:
             raise Autherize.auth_exception("access denied")
@@ -93,23 +145,22 @@ class Autherize:
             if time_diff < Autherize.TIME_GAP:
                 raise Autherize.auth_exception(f"Time period is not reached. remaining: {Autherize.TIME_GAP - time_diff}")
 
-        return (record_form, record, volunteer)
+        return (record_form, record, current_user)
 
     @staticmethod
-    def dep_elder_volunteer_linked(current_user: Annotated[UserBase, Depends(dep_get_current_user)]):
-        record = Autherize.db.get_elder_record_by_email(current_user.email, current_user.user_type)
+    async def dep_elder_volunteer_linked(current_user: Annotated[UserBase, Depends(dep_get_current_user)], session: Annotated[AsyncSession, Depends(dep_session)]):
+        record = await Autherize.db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
         if record is None or record.status != ElderStatus.assigned:
             raise Autherize.auth_exception(f"access denied")
         if current_user.user_type == "elder":
-            partner = Autherize.db.get_user_by_email(record.volunteer_email)
+            partner = await Autherize.get_principal(session, record.volunteer_email)
         else:
-            partner = Autherize.db.get_user_by_email(record.user_email)
+            partner = await Autherize.get_principal(session, record.user_email)
 
-        return (current_user, Autherize.db.from_DBModel_to_responseModel(partner), record) 
+        return (current_user, partner, record)
 
     @staticmethod
     def dep_only_admin(current_user: Annotated[UserBase, Depends(dep_get_current_user)]):
-        for email, (name, password) in captain_institutions.items():
-            if current_user.email == email and Authent.verify_password(password, current_user.password):
-                return current_user
+        if Autherize.db.is_admin(current_user.email):
+            return current_user
         raise Autherize.auth_exception("invalid admin credentials")
@@ -0,0 +1,207 @@
+from typing import AsyncIterator, Dict, Optional, Set, Tuple
+from encoding import encode, decode as decode_json
+import asyncio
+import config
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class StateBackend:
+    """State and pub/sub shared by every server process.
+
+    ``presence`` maps ``"<kind>:<email>"`` to the node id holding that websocket
+    and the user's attributes (see registry.py),
+    ``services`` maps service_id to the service's fields, each field's value
+    JSON encoded on its own; ``put_service`` merges the given fields into what
+    is stored, so workers changing different fields of a service do not
+    overwrite each other. ``publish``/``subscribe``
+    carry events between nodes. ``claim_service`` is an atomic first-wins claim,
+    so only one volunteer on any node can accept a service.
+    """
+
+    async def set_presence(self, key: str, node: str, attrs: dict):
+        raise NotImplementedError
+
+    async def clear_presence(self, key: str, node: str):
+        raise NotImplementedError
+
+    async def presence(self) -> Dict[str, Tuple[str, dict]]:
+        raise NotImplementedError
+
+    async def put_service(self, service_id: str, fields: Dict[str, str]):
+        raise NotImplementedError
+
+    async def delete_service(self, service_id: str):
+        raise NotImplementedError
+
+    async def service(self, service_id: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError
+
+    async def services(self) -> Dict[str, Dict[str, str]]:
+        raise NotImplementedError
+
+    async def claim_service(self, service_id: str, email: str) -> bool:
+        raise NotImplementedError
+
+    async def publish(self, channel: str, message: str):
+        raise NotImplementedError
+
+    def subscribe(self, *channels: str) -> AsyncIterator[Tuple[str, str]]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Everything in this process, the default for a single worker."""
+
+    def __init__(self):
+        self.presence_map: Dict[str, Tuple[str, dict]] = {}
+        self.service_map: Dict[str, Dict[str, str]] = {}
+        self.claims: Dict[str, str] = {}
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+
+    async def set_presence(self, key: str, node: str, attrs: dict):
+        self.presence_map[key] = (node, attrs)
+
+    async def clear_presence(self, key: str, node: str):
+        if self.presence_map.get(key, (None,))[0] == node:
+            del self.presence_map[key]
+
+    async def presence(self) -> Dict[str, Tuple[str, dict]]:
+        return dict(self.presence_map)
+
+    async def put_service(self, service_id: str, fields: Dict[str, str]):
+        self.service_map.setdefault(service_id, {}).update(fields)
+
+    async def delete_service(self, service_id: str):
+        self.service_map.pop(service_id, None)
+        self.claims.pop(service_id, None)
+
+    async def service(self, service_id: str) -> Optional[Dict[str, str]]:
+        fields = self.service_map.get(service_id)
+        return None if fields is None else dict(fields)
+
+    async def services(self) -> Dict[str, Dict[str, str]]:
+        return {service_id: dict(fields) for service_id, fields in self.service_map.items()}
+
+    async def claim_service(self, service_id: str, email: str) -> bool:
+        if service_id in self.claims:
+            return False
+        self.claims[service_id] = email
+        return True
+
+    async def publish(self, channel: str, message: str):
+        for queue in self.subscribers.get(channel, ()):
+            queue.put_nowait((channel, message))
+
+    async def subscribe(self, *channels: str) -> AsyncIterator[Tuple[str, str]]:
+        queue = asyncio.Queue()
+        for channel in channels:
+            self.subscribers.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            for channel in channels:
+                self.subscribers[channel].discard(queue)
+
+
+class RedisBackend(StateBackend):
+    """Redis hashes for state and claims, Redis pub/sub for events.
+
+    Each service is its own hash of fields under ``<prefix>:service:<id>``, the
+    ids are kept in the ``<prefix>:service_ids`` set.
+
+    ``client`` is a ``redis.asyncio.Redis`` or anything with the same API
+    (e.g. ``fakeredis.aioredis.FakeRedis`` as a local stand-in).
+    """
+
+    def __init__(self, client, prefix: str = config.STATE_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self.presence_key = f"{prefix}:presence"
+        self.services_key = f"{prefix}:service_ids"
+        self.claims_key = f"{prefix}:claims"
+
+    @staticmethod
+    def from_url(url: str = config.REDIS_URL) -> "RedisBackend":
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        return RedisBackend(redis.from_url(url))
+
+    def channel(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def set_presence(self, key: str, node: str, attrs: dict):
+        await self.client.hset(self.presence_key, key, encode({"node": node, "attrs": attrs}))
+
+    async def clear_presence(self, key: str, node: str):
+        # a newer connection on another node may own the key by now, leave that one alone
+        value = await self.client.hget(self.presence_key, key)
+        if value is not None and decode_json(decode(value))["node"] == node:
+            await self.client.hdel(self.presence_key, key)
+
+    async def presence(self) -> Dict[str, Tuple[str, dict]]:
+        entries = await self.client.hgetall(self.presence_key)
+        presence = {}
+        for key, value in entries.items():
+            entry = decode_json(decode(value))
+            presence[decode(key)] = (entry["node"], entry["attrs"])
+        return presence
+
+    def service_key(self, service_id: str) -> str:
+        return f"{self.prefix}:service:{service_id}"
+
+    async def put_service(self, service_id: str, fields: Dict[str, str]):
+        await self.client.hset(self.service_key(service_id), mapping=fields)
+        await self.client.sadd(self.services_key, service_id)
+
+    async def delete_service(self, service_id: str):
+        await self.client.delete(self.service_key(service_id))
+        await self.client.srem(self.services_key, service_id)
+        await self.client.hdel(self.claims_key, service_id)
+
+    async def service(self, service_id: str) -> Optional[Dict[str, str]]:
+        entries = await self.client.hgetall(self.service_key(service_id))
+        return {decode(field): decode(value) for field, value in entries.items()} or None
+
+    async def services(self) -> Dict[str, Dict[str, str]]:
+        services = {}
+        for service_id in await self.client.smembers(self.services_key):
+            fields = await self.service(decode(service_id))
+            if fields is not None:
+                services[decode(service_id)] = fields
+        return services
+
+    async def claim_service(self, service_id: str, email: str) -> bool:
+        return bool(await self.client.hsetnx(self.claims_key, service_id, email))
+
+    async def publish(self, channel: str, message: str):
+        await self.client.publish(self.channel(channel), message)
+
+    async def subscribe(self, *channels: str) -> AsyncIterator[Tuple[str, str]]:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(*(self.channel(channel) for channel in channels))
+        skip = len(self.prefix) + 1
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield decode(message["channel"])[skip:], decode(message["data"])
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def make_backend() -> StateBackend:
+    if config.STATE_BACKEND == "redis":
+        return RedisBackend.from_url()
+    return MemoryBackend()
@@ -0,0 +1,82 @@
+# usage: python bench_broadcast.py [volunteers] [image_kb]   e.g. python bench_broadcast.py 1000 300
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from datetime import date
+import encoding
+from broadcast import Broadcaster
+from model import UserBase, str_userbase
+
+volunteers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+image_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 300  # profile images are capped at 500 KB before base64
+ROUNDS = 5
+
+elder = UserBase.model_construct(
+    user_type="elder", full_name="Bench Elder", email="elder@example.com", dob=date(1950, 1, 1),
+    contact_number="+919876543210", bio="bench", location="10.0,76.3", latitude=10.0, longitude=76.3,
+    profile_image=base64.b64encode(os.urandom(image_kb * 1024)).decode(), volunteer_credits=0,
+    institution_id="1", institution="MES College, Marampally", approve=True, password="")
+service_form = {"description": "help with groceries", "locations": ["http://maps|home"], "urgent": True}
+
+
+class Sink:
+    def __init__(self):
+        self.bytes = 0
+
+    async def send_text(self, text):
+        self.bytes += len(text)
+
+    async def close(self, code):
+        pass
+
+
+def request(profile):
+    return {"type": "new_service_request", "service_id": "bench", "elder_profile": profile,
+            "service_form": service_form, "timeout": "2099-01-01 00:00:00"}
+
+
+def per_recipient(hub, emails):
+    # what new_service_request/load_aayi used to do: build and dump the event for every volunteer
+    for email in emails:
+        hub.send(email, json.dumps(request(str_userbase(elder))))
+
+
+def encode_once(hub, emails, encode):
+    hub.broadcast(emails, encode(request(str_userbase(elder))))
+
+
+async def run(label, fanout):
+    hub = Broadcaster(max_queue=ROUNDS + 1, send_timeout=10)
+    emails = [f"volunteer{i}@example.com" for i in range(volunteers)]
+    sinks = [Sink() for _ in emails]
+    for email, sink in zip(emails, sinks):
+        hub.attach(email, sink)
+    best_fanout = best_total = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fanout(hub, emails)
+        fanned = time.perf_counter()
+        while any(c.queue.qsize() for c in hub.connections.values()):
+            await asyncio.sleep(0)
+        best_fanout = min(best_fanout, fanned - start)
+        best_total = min(best_total, time.perf_counter() - start)
+    writers = [connection.task for connection in hub.connections.values()]
+    for email, connection in list(hub.connections.items()):
+        hub.detach(email, connection)
+    await asyncio.gather(*writers, return_exceptions=True)
+    print(f"{label:>22} {best_fanout * 1000:>9.1f}ms {best_total * 1000:>9.1f}ms {sinks[0].bytes // ROUNDS:>9}")
+
+
+async def main():
+    print(f"{volunteers} volunteers, {image_kb} KB profile image, best of {ROUNDS}")
+    print(f"{'':>22} {'fan-out':>11} {'delivered':>11} {'bytes':>9}")
+    await run("json per recipient", per_recipient)
+    await run("json once", lambda hub, emails: encode_once(hub, emails, json.dumps))
+    if encoding.orjson is not None:
+        await run("orjson once", lambda hub, emails: encode_once(hub, emails, encoding.encode))
+
+
+asyncio.run(main())
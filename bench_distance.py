@@ -0,0 +1,33 @@
+# usage: python bench_distance.py [sizes...]   e.g. python bench_distance.py 10000 100000 1000000
+import sys
+import time
+import numpy as np
+from util import Util
+
+sizes = [int(n) for n in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+K = 10
+rng = np.random.default_rng(0)
+origin = (10.0, 76.3)
+
+print(f"{'volunteers':>10} {'scalar+sort':>12} {'vectorized':>11} {'top-k':>9} {'speedup':>8}")
+for n in sizes:
+    lats = rng.uniform(8.0, 13.0, n)
+    lons = rng.uniform(74.0, 78.0, n)
+    lat_list, lon_list = lats.tolist(), lons.tolist()
+
+    start = time.perf_counter()
+    scalar = sorted(
+        (Util.calculate_distance(origin[0], origin[1], lat, lon), i)
+        for i, (lat, lon) in enumerate(zip(lat_list, lon_list)))[:K]
+    scalar_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Util.calculate_distances(origin[0], origin[1], lats, lons)
+    vector_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    idx, dist = Util.nearest_k(origin[0], origin[1], lats, lons, K)
+    topk_s = time.perf_counter() - start
+
+    assert [i for _, i in scalar] == idx.tolist()
+    print(f"{n:>10} {scalar_s * 1000:>10.1f}ms {vector_s * 1000:>9.1f}ms {topk_s * 1000:>7.1f}ms {scalar_s / topk_s:>7.1f}x")
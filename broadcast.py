@@ -0,0 +1,150 @@
+from typing import Dict, Iterable, Optional, Union
+from fastapi import WebSocket
+import asyncio
+
+# 1013 "try again later": the server dropped a client that could not keep up
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# close_socket tasks of dropped connections, referenced until they finish
+closing: set = set()
+
+
+class Connection:
+    """A websocket with a bounded outbox drained by its own writer task.
+
+    ``send`` only enqueues, so fan-out never waits on a client. A client whose
+    outbox is full, or whose socket does not take a message within
+    ``send_timeout`` seconds, is dropped and its socket closed; its reader loop
+    then ends and the usual disconnect cleanup runs.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int, send_timeout: float, on_drop=None):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.send_timeout = send_timeout
+        self.on_drop = on_drop
+        self.closed = False
+        self.task = asyncio.create_task(self.writer())
+
+    def send(self, text: str) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.drop()
+            return False
+        return True
+
+    async def writer(self):
+        try:
+            # checked as well as cancel(): wait_for before Python 3.12 can swallow a cancellation
+            while not self.closed:
+                text = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.drop()
+
+    def drop(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.on_drop is not None:
+            self.on_drop(self)
+        if asyncio.current_task() is not self.task:
+            self.task.cancel()
+        task = asyncio.create_task(self.close_socket())
+        closing.add(task)
+        task.add_done_callback(closing.discard)
+
+    async def close_socket(self):
+        try:
+            await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
+
+    def stop(self):
+        # the client went away, nothing left to deliver
+        self.closed = True
+        self.task.cancel()
+
+
+class Channel:
+    """One channel of a multiplexed ``Connection``.
+
+    Every message sent through it is wrapped as ``{"channel": name, "data": message}``
+    by string concatenation, so an event encoded once for many recipients is
+    not encoded again per channel.
+    """
+
+    def __init__(self, connection: Connection, name: str):
+        self.connection = connection
+        self.name = name
+        self.prefix = '{"channel":"%s","data":' % name
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        return self.connection.queue
+
+    def send(self, text: str) -> bool:
+        return self.connection.send(self.prefix + text + "}")
+
+    def stop(self):
+        pass  # the socket is shared with the other channels, its endpoint stops the connection
+
+
+class Broadcaster:
+    """This worker's websockets by email, each behind a ``Connection`` or a ``Channel`` of one."""
+
+    def __init__(self, max_queue: int, send_timeout: float):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.connections: Dict[str, Union[Connection, Channel]] = {}
+        self.dropped = 0
+
+    def __contains__(self, email: str):
+        return email in self.connections
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get(self, email: str) -> Optional[Union[Connection, Channel]]:
+        return self.connections.get(email)
+
+    def open(self, websocket: WebSocket) -> Connection:
+        return Connection(websocket, self.max_queue, self.send_timeout, self.count_drop)
+
+    def add(self, email: str, connection):
+        self.connections[email] = connection
+
+    def attach(self, email: str, websocket: WebSocket) -> Connection:
+        connection = self.open(websocket)
+        self.add(email, connection)
+        return connection
+
+    def detach(self, email: str, connection: Union[Connection, Channel]) -> bool:
+        """Forget the connection, returns False if a newer one replaced it already."""
+        connection.stop()
+        if self.connections.get(email) is not connection:
+            return False
+        del self.connections[email]
+        return True
+
+    def count_drop(self, connection: Connection):
+        self.dropped += 1
+
+    def send(self, email: str, text: str) -> bool:
+        connection = self.connections.get(email)
+        return connection is not None and connection.send(text)
+
+    def broadcast(self, emails: Iterable[str], text: str) -> int:
+        return sum(self.send(email, text) for email in emails)
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "queued": sum(c.queue.qsize() for c in self.connections.values()),
+            "dropped_slow_consumers": self.dropped,
+        }
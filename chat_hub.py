@@ -0,0 +1,53 @@
+from typing import Dict, FrozenSet, Iterable, Optional, Set
+
+
+class ChatRooms:
+    """The two participants of each service's chat, indexed by service_id.
+
+    A room is opened on first use from the volunteer pairing or the service
+    request the service_id belongs to, once a volunteer is assigned. Messages
+    are routed to the other participant of the room instead of the client's
+    ``reciever``, and only participants may post. ``by_user`` lets
+    ``leave`` drop the rooms of a user that disconnected once nobody in them
+    is connected; they are reopened the same way on the next message.
+    """
+
+    def __init__(self):
+        self.rooms: Dict[str, FrozenSet[str]] = {}
+        self.by_user: Dict[str, Set[str]] = {}
+
+    def __contains__(self, service_id: str):
+        return service_id in self.rooms
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, service_id: str) -> Optional[FrozenSet[str]]:
+        return self.rooms.get(service_id)
+
+    def open(self, service_id: str, members: Iterable[str]) -> FrozenSet[str]:
+        members = frozenset(members)
+        if self.rooms.get(service_id) == members:
+            return members
+        self.close(service_id)
+        self.rooms[service_id] = members
+        for email in members:
+            self.by_user.setdefault(email, set()).add(service_id)
+        return members
+
+    def close(self, service_id: str):
+        for email in self.rooms.pop(service_id, ()):
+            rooms = self.by_user.get(email)
+            if rooms is not None:
+                rooms.discard(service_id)
+                if not rooms:
+                    del self.by_user[email]
+
+    def leave(self, email: str, connected):
+        """Drop the user's rooms in which no participant is ``connected`` anymore."""
+        for service_id in list(self.by_user.get(email, ())):
+            if not any(connected(member) for member in self.rooms[service_id]):
+                self.close(service_id)
+
+    def stats(self) -> dict:
+        return {"rooms": len(self.rooms), "users": len(self.by_user)}
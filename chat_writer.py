@@ -0,0 +1,240 @@
+from typing import Dict, Iterable, List
+import asyncio
+import fcntl
+import glob
+import os
+import time
+from sqlalchemy.exc import OperationalError
+from encoding import encode, decode
+from model import ChatStatus
+
+
+class ChatWriter:
+    """Write-behind persistence for chat messages.
+
+    ``add`` appends the message to this worker's journal file and to an in-memory
+    buffer and returns; the relay never waits on the database. ``run`` flushes
+    the buffer in one executemany INSERT + commit whenever ``batch_size``
+    messages are waiting or every ``flush_interval`` seconds.
+
+    On flush the journal is renamed to ``.flushing`` and a fresh one started;
+    the ``.flushing`` file is deleted once its batch is committed. A worker that
+    dies leaves its files behind and the next worker to start replays them
+    (delivery to the database is at-least-once). Each worker holds a lock on
+    ``<node>.lock`` while alive, so live workers' journals are never replayed.
+
+    A batch the database refuses is retried one row at a time; rows that still
+    fail are appended to ``<node>.dead`` with the error and dropped from the
+    queue, so one bad row cannot hold up the rest. An unreachable database
+    (OperationalError) keeps every row queued for the next flush instead.
+
+    ``ack`` marks messages delivered once their receiver confirms them: rows
+    still in the buffer are changed in place, the rest are updated by the next
+    flush, after its INSERT.
+    """
+
+    def __init__(self, db, directory: str, node: str, batch_size: int, flush_interval: float,
+                 fsync: bool = False):
+        self.db = db
+        self.directory = directory
+        self.node = node
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.buffer: List[dict] = []
+        self.inflight: List[dict] = []
+        self.buffered: Dict[str, dict] = {}  # buffer rows by message_id
+        self.acks: Dict[str, str] = {}  # message_id -> receiver, for rows not in the buffer
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.journal = None
+        self.lock_file = None
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.replayed = 0
+        self.dead = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def path(self, node: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{node}.{suffix}")
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock_file = open(self.path(self.node, "lock"), "w")
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        await self.recover()
+        self.journal = open(self.path(self.node, "journal"), "a", encoding="utf-8")
+
+    async def recover(self):
+        nodes = {os.path.basename(path).rsplit(".", 1)[0]
+                 for pattern in ("*.journal", "*.flushing")
+                 for path in glob.glob(os.path.join(self.directory, pattern))}
+        for node in sorted(nodes):
+            lock = None
+            if node != self.node:
+                lock = open(self.path(node, "lock"), "a")
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock.close()
+                    continue  # that worker is still running
+            paths = [self.path(node, "flushing"), self.path(node, "journal")]
+            rows = []
+            for path in paths:
+                if os.path.exists(path):
+                    with open(path, encoding="utf-8") as journal:
+                        # a torn last line from a crash mid-write is skipped
+                        for line in journal:
+                            try:
+                                row = decode(line)
+                            except ValueError:
+                                continue
+                            row.setdefault("message_id", None)  # journals written before message ids
+                            rows.append(row)
+            if rows:
+                if await self.insert(rows):
+                    raise RuntimeError(f"could not replay the chat journal of {node}")
+                self.replayed += len(rows)
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            if lock is not None:
+                os.remove(self.path(node, "lock"))
+                lock.close()
+
+    def add(self, message: dict):
+        row = self.db.chat_row(message)
+        self.journal.write(encode(row) + "\n")
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        self.buffer.append(row)
+        if row["message_id"] is not None:
+            self.buffered[row["message_id"]] = row
+        if len(self.buffer) >= self.batch_size:
+            self.full.set()
+
+    def rotate(self):
+        # no await in here: nothing can be appended between the rename and the buffer swap
+        self.journal.close()
+        os.replace(self.path(self.node, "journal"), self.path(self.node, "flushing"))
+        self.journal = open(self.path(self.node, "journal"), "a", encoding="utf-8")
+        self.inflight, self.buffer = self.buffer, []
+        self.buffered = {}
+
+    def ack(self, reciever: str, message_ids: Iterable[str]):
+        for message_id in message_ids:
+            row = self.buffered.get(message_id)
+            if row is not None:
+                if row["reciever"] == reciever:
+                    row["status"] = ChatStatus.delivered
+            else:
+                self.acks[message_id] = reciever
+
+    async def flush(self) -> bool:
+        # also called outside run(), e.g. before replaying a reconnecting user's messages
+        async with self.lock:
+            return await self.flush_locked()
+
+    async def flush_locked(self) -> bool:
+        if not self.inflight:
+            if not self.buffer:
+                return await self.flush_acks()
+            self.rotate()
+        start = time.perf_counter()
+        dead = self.dead
+        pending = await self.insert(self.inflight)
+        if pending:
+            # kept in inflight and in the .flushing file, retried on the next flush;
+            # rows of it already stored are skipped then by their message_id
+            self.inflight = pending
+            return False
+        os.remove(self.path(self.node, "flushing"))
+        self.last_flush_ms = (time.perf_counter() - start) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.flushed += len(self.inflight) - (self.dead - dead)
+        self.batches += 1
+        self.inflight = []
+        return await self.flush_acks()
+
+    async def insert(self, rows: List[dict]) -> List[dict]:
+        """Store rows, returning the ones to try again later."""
+        try:
+            async with self.db.session_factory() as session:
+                await self.db.add_messages(session, rows)
+            return []
+        except OperationalError as e:
+            self.failures += 1
+            print("ERROR: ", e)
+            return rows
+        except Exception as e:
+            self.failures += 1
+            print("ERROR: ", e)
+        for index, row in enumerate(rows):
+            try:
+                async with self.db.session_factory() as session:
+                    await self.db.add_messages(session, [row])
+            except OperationalError as e:
+                print("ERROR: ", e)
+                return rows[index:]
+            except Exception as e:
+                self.dead_letter(row, e)
+        return []
+
+    def dead_letter(self, row: dict, error: Exception):
+        with open(self.path(self.node, "dead"), "a", encoding="utf-8") as dead:
+            dead.write(encode({"row": row, "error": str(error)}) + "\n")
+        self.dead += 1
+
+    async def flush_acks(self) -> bool:
+        if not self.acks:
+            return True
+        # acks that arrive meanwhile go to a new dict and wait for the next flush
+        acks, self.acks = self.acks, {}
+        try:
+            async with self.db.session_factory() as session:
+                await self.db.mark_delivered(session, acks)
+        except Exception as e:
+            self.failures += 1
+            print("ERROR: ", e)
+            self.acks = {**acks, **self.acks}
+            return False
+        return True
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            while await self.flush() and len(self.buffer) >= self.batch_size:
+                pass
+
+    async def close(self):
+        # inflight first, then whatever is still buffered
+        for _ in range(2):
+            if not await self.flush():
+                break
+        if self.journal is not None:
+            self.journal.close()
+            if not self.buffer and not self.inflight:
+                os.remove(self.path(self.node, "journal"))
+                os.remove(self.path(self.node, "lock"))
+        if self.lock_file is not None:
+            self.lock_file.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.buffer) + len(self.inflight),
+            "acks": len(self.acks),
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failures": self.failures,
+            "replayed": self.replayed,
+            "dead": self.dead,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
@@ -1,10 +1,48 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy import \
-    Column, Integer, String, Date, ForeignKey, DateTime, Text, Boolean
+    Column, Integer, String, Date, ForeignKey, DateTime, Text, Boolean, Float, Index
 from datetime import datetime
+from blob_store import BlobStore, KEY_PATTERN
+import base64
+import binascii
+import fcntl
+import config
+
+
+def engine_options() -> dict:
+    return dict(
+        echo=config.DB_ECHO,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING)
+
+
+def add_sqlite_pragmas(engine):
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run alongside the single writer instead of locking the whole file
+        if config.SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+
+# sync engine, only used to create the schema, see setup_schema; requests go through the async engine in db_op
+def make_engine(url: str = config.DATABASE_URL):
+    is_sqlite = url.startswith("sqlite")
+    engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False} if is_sqlite else {},
+        **engine_options())
+    if is_sqlite:
+        add_sqlite_pragmas(engine)
+    return engine
 
-engine = create_engine('sqlite:///amanah.db', echo=True, connect_args={"check_same_thread": False})
 Base = declarative_base()
 
 
@@ -21,11 +59,15 @@ class UserModelDB(Base):
     institution = Column(String, nullable=False)  # new
     contact_number = Column(String(20), nullable=False)
     location = Column(String(100), nullable=False)
+    latitude = Column(Float, nullable=True)  # parsed from location, see migrate()
+    longitude = Column(Float, nullable=True)
     bio = Column(String, nullable=False)
     profile_image = Column(String, nullable=False)
     volunteer_credits = Column(Integer, nullable=True)
     approve = Column(Boolean, nullable=False)  # new
 
+    __table_args__ = (Index("ix_users_lat_lon", "latitude", "longitude"),)
+
 
 class ElderRecord(Base):
     __tablename__ = "elder_records"
@@ -71,13 +113,20 @@ class ChatMessage(Base):
     content = Column(Text, nullable=False)
     timestamp = Column(Text, nullable=False)
     status = Column(Text, default=False)
+    message_id = Column(Text, nullable=True, unique=True, index=True)  # assigned on relay, acked by the receiver
+
+    # history is read per service in id order, see DB.get_messages(), and
+    # undelivered messages per receiver, see DB.undelivered_messages()
+    __table_args__ = (
+        Index("ix_chat_messages_service_id_id", "service_id", "id"),
+        Index("ix_chat_messages_reciever_status_id", "reciever", "status", "id"))
 
 
 class ServicesModel(Base):
     __tablename__ = "service_forms"
 
     id = Column(Integer, primary_key=True, index=True)
-    service_id = Column(String, nullable=False)
+    service_id = Column(String, nullable=False, unique=True, index=True)
     data = Column(String, nullable=False)
 
 
@@ -93,4 +142,69 @@ class WeekendRecord(Base):
     status = Column(String(30), nullable=False)
 
 
-Base.metadata.create_all(engine)
+# create_all only creates missing tables, columns and indexes added later are applied here
+def migrate(engine):
+    with engine.begin() as conn:
+        columns = {c["name"] for c in inspect(conn).get_columns("users")}
+        for name in ("latitude", "longitude"):
+            if name not in columns:
+                conn.execute(text(f"ALTER TABLE users ADD COLUMN {name} FLOAT"))
+        if "message_id" not in {c["name"] for c in inspect(conn).get_columns("chat_messages")}:
+            conn.execute(text("ALTER TABLE chat_messages ADD COLUMN message_id TEXT"))
+
+        rows = conn.execute(text("SELECT id, location FROM users WHERE latitude IS NULL OR longitude IS NULL")).all()
+        updates = []
+        for user_id, location in rows:
+            try:
+                lat, lon = (float(part) for part in location.split(","))
+            except (AttributeError, ValueError):
+                continue
+            updates.append({"id": user_id, "lat": lat, "lon": lon})
+        if updates:
+            conn.execute(text("UPDATE users SET latitude = :lat, longitude = :lon WHERE id = :id"), updates)
+
+        # older databases could hold the same service_id more than once, keep the newest row
+        # so the unique index below can be built
+        conn.execute(text(
+            "DELETE FROM service_forms WHERE id NOT IN "
+            "(SELECT MAX(id) FROM service_forms GROUP BY service_id)"))
+
+        # profile images used to be stored base64 encoded in the row, move them to the blob store;
+        # one row at a time, not every image in memory at once
+        images = BlobStore(config.BLOB_DIR)
+        ids = conn.execute(text("SELECT id FROM users WHERE length(profile_image) > 68")).scalars().all()
+        for user_id in ids:
+            image = conn.execute(text("SELECT profile_image FROM users WHERE id = :id"), {"id": user_id}).scalar()
+            if KEY_PATTERN.match(image):
+                continue
+            try:
+                data = base64.b64decode(image, validate=True)
+            except (binascii.Error, ValueError):
+                continue
+            conn.execute(text("UPDATE users SET profile_image = :key WHERE id = :id"),
+                         {"key": images.write(data), "id": user_id})
+
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def setup_schema(url: str = config.DATABASE_URL):
+    """Create missing tables and apply migrate().
+
+    Run once per deploy (``python db_init.py``) or by each worker at startup
+    (DB_SETUP_ON_STARTUP); the lock file makes workers on the same host take
+    turns, so only the first one does any work and the rest find it done.
+    """
+    with open(config.DB_SETUP_LOCK, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        engine = make_engine(url)
+        try:
+            Base.metadata.create_all(engine)
+            migrate(engine)
+        finally:
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    setup_schema()
@@ -1,31 +1,61 @@
-from db_init import UserModelDB, ElderRecord, ChatMessage
-from model import UserBase, ElderStatus
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from db_init import UserModelDB, ElderRecord, ChatMessage, ServicesModel, engine_options, add_sqlite_pragmas
+from model import UserBase, ElderStatus, ChatStatus
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, insert, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from datetime import date
 from institutions import captain_institutions
+from encoding import encode, decode
+import asyncio
 import bcrypt
+import config
+
+# INSERT ... ON CONFLICT DO NOTHING, per dialect
+CONFLICT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+# read-merge-write rounds for a service whose row keeps changing underneath, see save_service_data
+SAVE_ATTEMPTS = 5
+
+
+def async_url(url: str) -> str:
+    if config.DATABASE_ASYNC_URL:
+        return config.DATABASE_ASYNC_URL
+    scheme, rest = url.split("://", 1)
+    return f"{config.ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
 
 
 class DB:
 
     def __init__(self):
-        self.engine = create_engine(
-            'sqlite:///amanah.db',
-            echo=True,
-            connect_args={"check_same_thread": False})
-
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        self.engine = create_async_engine(async_url(config.DATABASE_URL), **engine_options())
+        if self.engine.dialect.name == "sqlite":
+            add_sqlite_pragmas(self.engine.sync_engine)
+        self.session_factory = async_sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.admin_emails: set = set()
 
+    async def setup(self):
         print("institution: ", captain_institutions)
 
+        async with self.session_factory() as session:
+            await self.add_captains(session)
+            await self.load_admins(session)
+
+    async def get_session(self):
+        # one session (unit of work) per request, connections come from the engine pool
+        async with self.session_factory() as session:
+            yield session
+
+    async def add_captains(self, session: AsyncSession):
         for email, (name, password) in captain_institutions.items():
+            if await self.get_user_by_email(session, email) is not None:
+                continue
 
             pwd_bytes = password.encode('utf-8')
             gen_salt = bcrypt.gensalt()
-            new_pass = bcrypt.hashpw(pwd_bytes, gen_salt).decode('utf-8')
+            new_pass = (await asyncio.to_thread(bcrypt.hashpw, pwd_bytes, gen_salt)).decode('utf-8')
 
             captian = UserModelDB(
                 user_type="volunteer",
@@ -40,38 +70,67 @@ class DB:
                 profile_image="no profile",
                 volunteer_credits=0,
                 location="0.0,0.0",
+                latitude=0.0,
+                longitude=0.0,
                 approve=True
             )
-            if self.session.query(UserModelDB).filter(UserModelDB.email == email).first() is None:
-                self.session.add(captian)
-        self.session.commit()
+            session.add(captian)
+            try:
+                await session.commit()
+            except IntegrityError:
+                # another worker starting at the same time added this one first
+                await session.rollback()
+
+    async def load_admins(self, session: AsyncSession):
+        # a captain is an admin while its stored hash still matches the institution password;
+        # checked once at startup instead of with bcrypt on every admin request. No endpoint
+        # changes a captain's password, it changes with institutions.py, i.e. on a restart
+        admins = set()
+        for email, (name, password) in captain_institutions.items():
+            captain = await self.get_user_by_email(session, email)
+            if captain is None:
+                continue
+            if await asyncio.to_thread(bcrypt.checkpw, password.encode('utf-8'), captain.password.encode('utf-8')):
+                admins.add(email)
+        self.admin_emails = admins
 
-    def get_unassigned_volunteers(self):
+    def is_admin(self, email: str) -> bool:
+        return email in self.admin_emails
+
+    async def get_unassigned_volunteers(self, session: AsyncSession):
         stmt = select(UserModelDB).join(ElderRecord, UserModelDB.email == ElderRecord.volunteer_email, isouter=True).filter(
             UserModelDB.user_type == "volunteer",
             (ElderRecord.volunteer_email == None) |
             (ElderRecord.status != "assigned")
         )
-        result = self.session.execute(stmt).scalars().all()
+        result = (await session.execute(stmt)).scalars().all()
         return result
 
-    def get_elder_record_by_email(self, email: str, user_type: str):
+    async def get_elder_record_by_email(self, session: AsyncSession, email: str, user_type: str):
         if user_type == "elder":
             stmt = select(ElderRecord).where(ElderRecord.user_email == email)
         elif user_type == "volunteer":
             stmt = select(ElderRecord).where(ElderRecord.volunteer_email == email)
         else:
             raise ValueError("Invalid user type. Must be 'elder' or 'volunteer'.")
+        # the record status is changed by other requests, always take the stored row over the identity map
+        stmt = stmt.execution_options(populate_existing=True)
 
-        result = self.session.execute(stmt).scalars().first()
+        result = (await session.execute(stmt)).scalars().first()
         return result
 
-    def get_user_by_email(self, email: str):
+    async def get_user_by_email(self, session: AsyncSession, email: str):
         stmt = select(UserModelDB).where(UserModelDB.email == email)
-        result = self.session.execute(stmt).scalars().first()
+        result = (await session.execute(stmt)).scalars().first()
         return result
 
-    def create_empty_elder_record(self, user: UserBase):
+    async def add_volunteer_credits(self, session: AsyncSession, email: str, credits: int):
+        # single UPDATE, no need to load the user row just to bump a counter
+        stmt = update(UserModelDB).where(UserModelDB.email == email).values(
+            volunteer_credits=UserModelDB.volunteer_credits + credits)
+        await session.execute(stmt)
+
+    async def create_empty_elder_record(self, session: AsyncSession, user: UserBase):
         new_record = ElderRecord(
             user_email=user.email,
             status=ElderStatus.not_assigned,
@@ -86,8 +145,8 @@ class DB:
             # height=None,
             last_check_in=None,
         )
-        self.session.add(new_record)
-        self.session.commit()
+        session.add(new_record)
+        await session.commit()
         return new_record
 
     def from_responseModel_to_dbModel(user: UserBase) -> UserModelDB:
@@ -102,13 +161,16 @@ class DB:
             profile_image=user.profile_image,
             volunteer_credits=user.volunteer_credits,
             location=user.location,
+            latitude=user.latitude,
+            longitude=user.longitude,
             institution=user.institution,
             institution_id=user.institution_id,
             approve=user.approve
         )
 
     def from_DBModel_to_responseModel(self, user: UserModelDB) -> UserBase:
-        return UserBase(
+        # rows were validated on the way in, skip re-running the field validators and regexes
+        return UserBase.model_construct(
             user_type=user.user_type,
             full_name=user.full_name,
             email=user.email,
@@ -118,25 +180,150 @@ class DB:
             bio=user.bio,
             profile_image=user.profile_image,
             location=user.location,
+            latitude=user.latitude,
+            longitude=user.longitude,
             volunteer_credits=user.volunteer_credits,
             institution=user.institution,
             institution_id=user.institution_id,
             approve=user.approve
         )
 
-    def add_user(self, user: UserBase):
+    async def add_user(self, session: AsyncSession, user: UserBase):
         new_user = DB.from_responseModel_to_dbModel(user)
-        self.session.add(new_user)
-        self.session.commit()
+        session.add(new_user)
+        await session.commit()
 
-    def add_message(self, response: dict):
-        message = ChatMessage(
+    def chat_row(self, response: dict) -> dict:
+        return dict(
             content=response["content"],
             service_id=response["service_id"],
             sender=response["sender"],
             timestamp=response["timestamp"],
             reciever=response["reciever"],
-            status=response["status"]
+            status=response["status"],
+            message_id=response.get("message_id")
         )
-        self.session.add(message)
-        self.session.commit()
+
+    async def add_messages(self, session: AsyncSession, rows: List[dict]):
+        """Insert a batch of chat_row() dicts with one executemany and one commit.
+
+        Rows whose message_id is already stored are skipped, so a journal replayed
+        after a crash between the commit and its removal does not fail.
+        """
+        conflict_insert = CONFLICT_INSERTS.get(self.engine.dialect.name)
+        if conflict_insert is None:
+            stmt = insert(ChatMessage)
+        else:
+            stmt = conflict_insert(ChatMessage).on_conflict_do_nothing(index_elements=["message_id"])
+        await session.execute(stmt, rows)
+        await session.commit()
+
+    async def get_messages(self, session: AsyncSession, service_id: str, limit: int,
+                           before: Optional[int] = None, after: Optional[int] = None) -> List[dict]:
+        """One page of a conversation in id order, keyset paginated on (service_id, id).
+
+        Without ``after`` the page is the newest ``limit`` messages older than
+        ``before`` (or the newest overall); with ``after`` it is the oldest
+        ``limit`` messages newer than it.
+        """
+        stmt = select(*ChatMessage.__table__.c).where(ChatMessage.service_id == service_id)
+        if before is not None:
+            stmt = stmt.where(ChatMessage.id < before)
+        if after is not None:
+            stmt = stmt.where(ChatMessage.id > after)
+            stmt = stmt.order_by(ChatMessage.id).limit(limit)
+            return [dict(row) for row in (await session.execute(stmt)).mappings()]
+        stmt = stmt.order_by(ChatMessage.id.desc()).limit(limit)
+        rows = [dict(row) for row in (await session.execute(stmt)).mappings()]
+        rows.reverse()
+        return rows
+
+    async def iter_messages(self, service_id: str, batch: int) -> AsyncIterator[dict]:
+        """The whole conversation in id order, read ``batch`` rows at a time.
+
+        Each page uses its own short session, so a slow reader does not hold a
+        connection or a read transaction for the length of the export.
+        """
+        after = 0
+        while True:
+            async with self.session_factory() as session:
+                rows = await self.get_messages(session, service_id, batch, after=after)
+            for row in rows:
+                yield row
+            if len(rows) < batch:
+                return
+            after = rows[-1]["id"]
+
+    async def chat_participants(self, session: AsyncSession, service_id: str) -> Optional[Tuple[str, str]]:
+        """Elder and volunteer of a volunteer pairing or of a service request, None if unassigned."""
+        stmt = select(ElderRecord.user_email, ElderRecord.volunteer_email).where(ElderRecord.service_id == service_id)
+        row = (await session.execute(stmt)).first()
+        if row is not None and row.volunteer_email is not None:
+            return row.user_email, row.volunteer_email
+        stmt = select(ServicesModel.data).where(ServicesModel.service_id == service_id)
+        data = (await session.execute(stmt)).scalar()
+        if data is not None:
+            service = decode(data)
+            if "volunteer_email" in service:
+                return service["elder_email"], service["volunteer_email"]
+        return None
+
+    async def undelivered_messages(self, session: AsyncSession, email: str, after: int, limit: int) -> List[dict]:
+        table = ChatMessage.__table__
+        stmt = (
+            select(*table.c)
+            .where(table.c.reciever == email, table.c.status == ChatStatus.sent, table.c.id > after)
+            .order_by(table.c.id)
+            .limit(limit))
+        return [dict(row) for row in (await session.execute(stmt)).mappings()]
+
+    async def mark_delivered(self, session: AsyncSession, acks: Dict[str, str]):
+        """Mark {message_id: receiver} delivered; a message is only acked by its own receiver."""
+        table = ChatMessage.__table__
+        by_reciever: Dict[str, List[str]] = {}
+        for message_id, reciever in acks.items():
+            by_reciever.setdefault(reciever, []).append(message_id)
+        for reciever, message_ids in by_reciever.items():
+            for start in range(0, len(message_ids), 500):  # stay under the bound parameter limit
+                await session.execute(
+                    update(table)
+                    .where(table.c.message_id.in_(message_ids[start:start + 500]), table.c.reciever == reciever)
+                    .values(status=ChatStatus.delivered))
+        await session.commit()
+
+    async def save_service_data(self, session: AsyncSession, changes: Dict[str, dict]):
+        """Merge the changed fields of each service into its stored JSON.
+
+        Only the fields given are written, so a field another worker changed
+        meanwhile is kept. Each UPDATE applies only if the row still holds the
+        JSON it was merged into; rows changed in between are read and merged
+        again, one by one. The first attempt is a single executemany.
+        """
+        table = ServicesModel.__table__
+        stmt = (
+            update(table)
+            .where(table.c.service_id == bindparam("b_service_id"), table.c.data == bindparam("b_old"))
+            .values(data=bindparam("b_data")))
+        pending = dict(changes)
+        for attempt in range(SAVE_ATTEMPTS):
+            if not pending:
+                break
+            rows = (await session.execute(
+                select(table.c.service_id, table.c.data).where(table.c.service_id.in_(list(pending))))).all()
+            params = [{"b_service_id": service_id, "b_old": data,
+                       "b_data": encode({**decode(data), **pending[service_id]})}
+                      for service_id, data in rows]
+            pending = {service_id: pending[service_id] for service_id, _ in rows}  # rows that exist
+            if not params:
+                break
+            if attempt == 0:
+                if (await session.execute(stmt, params)).rowcount == len(params):
+                    pending = {}
+                continue
+            for param in params:
+                if (await session.execute(stmt, param)).rowcount == 1:
+                    del pending[param["b_service_id"]]
+        if pending:
+            await session.rollback()
+            raise RuntimeError(f"services changed concurrently, not saved: {sorted(pending)}")
+        await session.commit()
@@ -0,0 +1,19 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+
+
+def encode(message) -> str:
+    """Serialize an outbound websocket event once; send the result to every recipient."""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message)
+
+
+def decode(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
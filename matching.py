@@ -0,0 +1,212 @@
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set
+from itertools import islice
+from model import str_userbase
+from encoding import encode
+import asyncio
+import uuid
+import config
+
+
+class Offer:
+    def __init__(self, future: asyncio.Future, elder_email: str, volunteers: Set[str]):
+        self.future = future
+        self.elder_email = elder_email
+        self.volunteers = volunteers
+        self.declined: Set[str] = set()
+
+
+class OfferRegistry:
+    """Outstanding volunteer offers keyed by the search's service_id.
+
+    A search opens an offer before sending ``new_volunteer_request`` and awaits its
+    future; the /ws handler routes each reply straight to the matching offer, so
+    concurrent searches never see each other's replies. The future resolves to the
+    accepting volunteer's email, or None once every offered volunteer declined.
+    """
+
+    def __init__(self):
+        self.offers: Dict[str, Offer] = {}
+        # volunteers whose accept has been taken but whose assignment is not committed yet;
+        # keeps one volunteer from being handed to two searches that offered it at the same time
+        self.claimed: Set[str] = set()
+
+    def open(self, service_id: str, elder_email: str, volunteers: Iterable[str]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.offers[service_id] = Offer(future, elder_email, set(volunteers))
+        return future
+
+    def close(self, service_id: str):
+        offer = self.offers.pop(service_id, None)
+        if offer is not None and not offer.future.done():
+            offer.future.cancel()
+
+    def resolve(self, service_id: str, elder_email: str, volunteer_email: str, accepted: bool) -> bool:
+        """Deliver a volunteer's reply, returns False if it matches no open offer."""
+        offer = self.offers.get(service_id)
+        if (offer is None or offer.future.done() or
+                offer.elder_email != elder_email or volunteer_email not in offer.volunteers):
+            return False
+        if accepted:
+            if volunteer_email in self.claimed:
+                return False
+            self.claimed.add(volunteer_email)
+            offer.future.set_result(volunteer_email)
+        else:
+            offer.declined.add(volunteer_email)
+            if offer.declined >= offer.volunteers:
+                offer.future.set_result(None)
+        return True
+
+    def release(self, volunteer_email: str):
+        self.claimed.discard(volunteer_email)
+
+    def resolve_reply(self, reply: str, volunteer_email: str) -> bool:
+        # reply format: "new_volunteer_request:<accept|reject>:<elder_email>:<service_id>"
+        parts = reply.split(":")
+        if len(parts) != 4:
+            return False
+        _, decision, elder_email, service_id = parts
+        return self.resolve(service_id, elder_email, volunteer_email, decision == "accept")
+
+
+class DispatchStrategy:
+    """How many of the nearest connected volunteers receive the offer in each round.
+
+    ``sequential`` offers one volunteer at a time; ``wave`` offers a growing batch
+    concurrently, so each round reaches further out from the elder.
+    """
+
+    def __init__(self, wave_size: int = 1, growth: float = 1.0, max_wave: int = 1):
+        self.wave_size = max(wave_size, 1)
+        self.growth = max(growth, 1.0)
+        self.max_wave = max(max_wave, self.wave_size)
+
+    @staticmethod
+    def from_config() -> "DispatchStrategy":
+        if config.MATCH_STRATEGY == "sequential":
+            return DispatchStrategy()
+        return DispatchStrategy(config.MATCH_WAVE_SIZE, config.MATCH_WAVE_GROWTH, config.MATCH_WAVE_MAX)
+
+    def wave_sizes(self) -> Iterator[int]:
+        size = float(self.wave_size)
+        while True:
+            yield int(size)
+            size = min(size * self.growth, self.max_wave)
+
+
+class Search:
+    def __init__(self, elder, timeout: float):
+        self.elder = elder
+        self.service_id = str(uuid.uuid4())
+        self.timeout = timeout
+        # offered without accepting; skipped until that volunteer changes state
+        self.tried: Set[str] = set()
+        self.wake = asyncio.Event()
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.task: Optional[asyncio.Task] = None
+
+
+class MatchingEngine:
+    """Keeps one background search per elder and only matches when something changes.
+
+    A search offers the elder in waves to the nearest connected volunteers it has
+    not tried yet. When it runs out of candidates it parks until a volunteer event
+    (connects, becomes unassigned, signs up or moves) wakes it, instead of
+    re-scanning on a timer. ``search.result`` resolves to the assigned volunteer's
+    email, or None when the elder is no longer searching.
+
+    The engine does not know about websockets or the database, the server passes in:
+    ``is_connected(email)``, ``send(email, text)``, ``still_searching(elder_email)``
+    and ``assign(search, volunteer_email) -> bool``.
+    """
+
+    def __init__(self, index, offers: OfferRegistry, strategy: DispatchStrategy,
+                 is_connected: Callable[[str], bool],
+                 send: Callable[[str, str], Awaitable[None]],
+                 still_searching: Callable[[str], Awaitable[bool]],
+                 assign: Callable[["Search", str], Awaitable[bool]]):
+        self.index = index
+        self.offers = offers
+        self.strategy = strategy
+        self.is_connected = is_connected
+        self.send = send
+        self.still_searching = still_searching
+        self.assign = assign
+        self.searches: Dict[str, Search] = {}
+
+    def start_search(self, elder, timeout: float) -> Search:
+        search = self.searches.get(elder.email)
+        if search is None:
+            search = Search(elder, timeout)
+            self.searches[elder.email] = search
+            search.task = asyncio.create_task(self.run(search))
+        return search
+
+    def volunteer_available(self, volunteer_email: str):
+        for search in self.searches.values():
+            search.tried.discard(volunteer_email)
+            search.wake.set()
+
+    def stop(self):
+        for search in list(self.searches.values()):
+            search.task.cancel()
+
+    async def run(self, search: Search):
+        lat, lon = search.elder.latitude, search.elder.longitude
+        offer = encode({
+            "type": "new_volunteer_request",
+            "elder_profile": str_userbase(search.elder),
+            "timeout": search.timeout,
+            "service_id": search.service_id
+        })
+        try:
+            while True:
+                # cleared before the scan so an event that lands mid-scan is not lost
+                search.wake.clear()
+                candidates = (email for _, email in self.index.iter_nearest(lat, lon)
+                              if email not in search.tried and self.is_connected(email))
+
+                for wave_size in self.strategy.wave_sizes():
+                    if not await self.still_searching(search.elder.email):
+                        search.result.set_result(None)
+                        return
+                    wave = list(islice(candidates, wave_size))
+                    if not wave:
+                        break
+                    search.tried.update(wave)
+
+                    accepted_by = await self.offer_wave(search, wave, offer)
+                    if accepted_by is None:
+                        continue
+                    try:
+                        if await self.assign(search, accepted_by):
+                            search.result.set_result(accepted_by)
+                            return
+                    finally:
+                        self.offers.release(accepted_by)
+
+                await search.wake.wait()
+        except Exception as e:
+            if not search.result.done():
+                search.result.set_exception(e)
+        finally:
+            if not search.result.done():
+                search.result.set_result(None)
+            self.searches.pop(search.elder.email, None)
+
+    async def offer_wave(self, search: Search, wave: List[str], offer: str) -> Optional[str]:
+        """Offer the elder to every volunteer in the wave at once, returns the first to accept."""
+        accepted_by = None
+        reply = self.offers.open(search.service_id, search.elder.email, wave)
+        try:
+            await asyncio.gather(*(self.send(email, offer) for email in wave), return_exceptions=True)
+            accepted_by = await asyncio.wait_for(reply, timeout=search.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.offers.close(search.service_id)
+
+        cancelled = encode({"type": "new_volunteer_request_cancelled", "service_id": search.service_id})
+        await asyncio.gather(*(self.send(email, cancelled) for email in wave if email != accepted_by),
+                             return_exceptions=True)
+        return accepted_by
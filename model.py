@@ -1,5 +1,5 @@
 from typing import Annotated, Literal, List, Optional
-from pydantic import BaseModel, EmailStr, Field, field_validator
+from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
 from datetime import date, datetime
 from fastapi import UploadFile, Form, File
 from enum import Enum
@@ -12,6 +12,10 @@ class ElderStatus:
     searching_a_volunteer: str = "searching_a_volunteer"
     assigned: str = "assigned"
 
+class ChatStatus:
+    sent: str = "sent"  # until the receiver acks its message_id, replayed on every reconnect
+    delivered: str = "delivered"
+
 class UserBase(BaseModel):
     user_type: Literal["volunteer", "elder"]
     full_name: str = Field( ..., min_length=2, max_length=100, description="User's full name",)
@@ -29,6 +33,8 @@ class UserBase(BaseModel):
         description="Location coords",
         examples=["10.2323,75.12323"],
     )
+    latitude: Optional[float] = Field(None, description="Latitude parsed from location")
+    longitude: Optional[float] = Field(None, description="Longitude parsed from location")
     bio: str = Field(
         ...,
         min_length=2,
@@ -43,9 +49,17 @@ class UserBase(BaseModel):
     profile_image: str = Field(
         ...,
         min_length=3,
-        description="Profile image as Base64 encoded string"
+        description="Key of the profile image in the blob store, served by GET /images/{profile_image}"
     )
 
+    @model_validator(mode="after")
+    def set_coordinates(self):
+        # parsed once when the user is validated (signup), rows loaded from the DB carry the columns
+        if self.latitude is None or self.longitude is None:
+            lat, lon = self.location.split(",")
+            self.latitude, self.longitude = float(lat), float(lon)
+        return self
+
 class UserCreate(UserBase):
     password: str = Field(
         ...,
@@ -117,6 +131,7 @@ class ServiceStatus(str, Enum):
     ACCEPTED = "accepted"
     COMPLETED = "completed"
     ABORTED = "aborted"
+    EXPIRED = "expired"  # nobody accepted before timeout_end
 
 async def get_record_form(
     data: Annotated[str, Form()] = None,
@@ -0,0 +1,72 @@
+from typing import Dict, Optional, Set, Tuple
+
+
+class ConnectionRegistry:
+    """Users connected to any worker, with live indexes on their attributes.
+
+    Each entry holds the node id serving the user and a few attributes
+    (user_type, institution, approve, admin), kept current from connect and
+    disconnect events. ``select(**criteria)`` starts from the smallest matching
+    index bucket, so finding e.g. the captains of one institution costs about
+    as much as the number of matches, without a database query.
+    """
+
+    def __init__(self, indexed: Tuple[str, ...] = ()):
+        self.indexed = indexed
+        self.nodes: Dict[str, str] = {}
+        self.attrs: Dict[str, dict] = {}
+        self.index: Dict[Tuple[str, object], Set[str]] = {}
+
+    def __contains__(self, email: str):
+        return email in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node_of(self, email: str) -> Optional[str]:
+        return self.nodes.get(email)
+
+    def add(self, email: str, node: str, attrs: dict):
+        self.remove(email)
+        self.nodes[email] = node
+        self.attrs[email] = attrs
+        for name in self.indexed:
+            if name in attrs:
+                self.index.setdefault((name, attrs[name]), set()).add(email)
+
+    def remove(self, email: str, node: Optional[str] = None) -> bool:
+        """Forget the user, only if still served by ``node`` when it is given."""
+        if email not in self.nodes or (node is not None and self.nodes[email] != node):
+            return False
+        del self.nodes[email]
+        attrs = self.attrs.pop(email)
+        for name in self.indexed:
+            if name in attrs:
+                key = (name, attrs[name])
+                members = self.index[key]
+                members.discard(email)
+                if not members:
+                    del self.index[key]
+        return True
+
+    def update(self, email: str, **attrs) -> bool:
+        if email not in self.nodes:
+            return False
+        self.add(email, self.nodes[email], {**self.attrs[email], **attrs})
+        return True
+
+    def select(self, **criteria) -> Set[str]:
+        if not criteria:
+            return set(self.nodes)
+        buckets = [self.index.get((name, value), set())
+                   for name, value in criteria.items() if name in self.indexed]
+        candidates = min(buckets, key=len) if buckets else self.nodes
+        return {email for email in candidates
+                if all(self.attrs[email].get(name) == value for name, value in criteria.items())}
+
+    def stats(self) -> dict:
+        by_type: Dict[str, int] = {}
+        for (name, value), members in self.index.items():
+            if name == "user_type":
+                by_type[value] = len(members)
+        return {"connected": len(self.nodes), "by_user_type": by_type}
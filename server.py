@@ -1,25 +1,36 @@
 from fastapi import FastAPI, Depends, HTTPException, \
     Query, status, UploadFile, WebSocket, Request
 from fastapi.security import OAuth2PasswordRequestForm
-from typing import Annotated, Tuple, Dict
+from typing import Annotated, Tuple, Dict, Set, Iterable, List, Optional
 from model import *
 from model import UserBase
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from autherize import Autherize
-from authenticate import Authent
+from authenticate import Authent, HashPoolFull
 from db_op import DB
 from db_init import ElderRecord, UserModelDB, \
-    Feedback, ChatMessage, ServicesModel, WeekendRecord
+    Feedback, ServicesModel, WeekendRecord, setup_schema
 from util import Util
+from spatial import VolunteerIndex
+from matching import OfferRegistry, DispatchStrategy, MatchingEngine, Search
+from service_store import ServiceStore
+from backend import make_backend
+from broadcast import Broadcaster, Channel
+from encoding import encode, decode
+from registry import ConnectionRegistry
+from chat_writer import ChatWriter
+from chat_hub import ChatRooms
+from blob_store import BlobStore
 from datetime import datetime, timedelta
 import os
-import json
 import asyncio
 import uuid
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
 from institutions import captain_institutions
-import copy
+import config
 
 
 app = FastAPI()
@@ -36,12 +47,174 @@ Autherize.db = db
 
 os.makedirs("uploads", exist_ok=True)
 
-connected_clients: Dict[str, WebSocket] = {}
-connected_clients_chat: Dict[str, WebSocket] = {}
-new_volunteer_request_queue = asyncio.Queue()
+# websockets held by this worker, each written by its own task from a bounded queue
+connected_clients = Broadcaster(config.WS_SEND_QUEUE, config.WS_SEND_TIMEOUT)
+connected_clients_chat = Broadcaster(config.WS_SEND_QUEUE, config.WS_SEND_TIMEOUT)
+local_clients = {"ws": connected_clients, "chat": connected_clients_chat}
+# presence, service state and fan-out shared by every worker, see backend.py
+backend = make_backend()
+# users connected to any worker (node id + indexed attributes), mirrored from backend presence events
+online = {
+    "ws": ConnectionRegistry(("user_type", "institution", "approve", "admin")),
+    "chat": ConnectionRegistry(),
+}
+# replies to new_volunteer_request are routed to the waiting search by service_id
+volunteer_offers = OfferRegistry()
 # new_service_request_queue = asyncio.Queue()
-active_services: Dict[str, dict] = {}
-lock = asyncio.Lock()
+# writes go through active_services.add/update/add_notified so on_change sees them immediately
+active_services = ServiceStore()
+chat_writer = ChatWriter(
+    db, config.CHAT_JOURNAL_DIR, config.NODE_ID,
+    config.CHAT_BATCH_SIZE, config.CHAT_FLUSH_INTERVAL, config.CHAT_JOURNAL_FSYNC)
+chat_rooms = ChatRooms()
+images = BlobStore(config.BLOB_DIR)
+# encoded new_service_request per active service, see encoded_offer
+offer_cache: Dict[str, str] = {}
+# volunteers that are not assigned to an elder, kept current on signup/update/assign/unassign/delete
+volunteer_index = VolunteerIndex(config.SPATIAL_CELL_DEG)
+
+
+background_jobs: Set[asyncio.Task] = set()
+
+
+def run_in_background(coro):
+    async def job():
+        try:
+            await coro
+        except Exception as e:
+            print("ERROR: ", e)
+    task = asyncio.create_task(job())
+    background_jobs.add(task)  # keep a reference until it finishes
+    task.add_done_callback(background_jobs.discard)
+
+
+def is_online(email: str, kind: str = "ws") -> bool:
+    return email in online[kind]
+
+
+async def send_to_many(emails: Iterable[str], text: str, kind: str = "ws"):
+    """Send one encoded message to many users, one publish per worker for the remote ones."""
+    remote: Dict[str, List[str]] = {}
+    for email in emails:
+        if email in local_clients[kind]:
+            local_clients[kind].send(email, text)
+        else:
+            node = online[kind].node_of(email)
+            if node is not None:
+                remote.setdefault(node, []).append(email)
+    for node, node_emails in remote.items():
+        await backend.publish(f"node:{node}", encode({"kind": kind, "emails": node_emails, "text": text}))
+
+
+async def send_to(email: str, text: str, kind: str = "ws"):
+    await send_to_many((email,), text, kind)
+
+
+def presence_attrs(user: UserBase) -> dict:
+    return {
+        "user_type": user.user_type,
+        "institution": user.institution,
+        "approve": user.approve,
+        "admin": db.is_admin(user.email),
+    }
+
+
+async def announce_presence(kind: str, email: str):
+    # "node" is the worker sending the event, "owner" the one holding the websocket
+    owner, attrs = online[kind].node_of(email), online[kind].attrs[email]
+    await backend.set_presence(f"{kind}:{email}", owner, attrs)
+    await backend.publish("presence", encode(
+        {"kind": kind, "email": email, "node": config.NODE_ID, "owner": owner, "attrs": attrs}))
+
+
+async def client_connected(kind: str, email: str, connection, attrs: dict = None):
+    local_clients[kind].add(email, connection)
+    online[kind].add(email, config.NODE_ID, attrs or {})
+    await announce_presence(kind, email)
+
+
+async def client_disconnected(kind: str, email: str, connection):
+    if not local_clients[kind].detach(email, connection):
+        return  # replaced by a newer connection
+    online[kind].remove(email, config.NODE_ID)
+    await backend.clear_presence(f"{kind}:{email}", config.NODE_ID)
+    await backend.publish("presence", encode(
+        {"kind": kind, "email": email, "node": config.NODE_ID, "owner": None}))
+
+
+async def update_presence(email: str, **attrs):
+    if online["ws"].update(email, **attrs):
+        await announce_presence("ws", email)
+
+
+async def elder_still_searching(elder_email: str) -> bool:
+    async with db.session_factory() as session:
+        record = await db.get_elder_record_by_email(session, elder_email, "elder")
+        return record is not None and record.status == ElderStatus.searching_a_volunteer
+
+
+async def assign_volunteer(search: Search, volunteer_email: str) -> bool:
+    async with db.session_factory() as session:
+        if await db.get_elder_record_by_email(session, volunteer_email, "volunteer") is not None:
+            return False  # picked by another elder since the offer went out
+        record = await db.get_elder_record_by_email(session, search.elder.email, "elder")
+        if record is None or record.status != ElderStatus.searching_a_volunteer:
+            return False
+        record.volunteer_email = volunteer_email
+        record.status = ElderStatus.assigned
+        record.service_id = search.service_id
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return False
+    await unindex_volunteer(volunteer_email)
+    await send_to(search.elder.email, encode({
+        "type": "volunteer_assigned",
+        "service_id": search.service_id,
+        "volunteer_email": volunteer_email
+    }))
+    return True
+
+
+matching_engine = MatchingEngine(
+    volunteer_index, volunteer_offers, DispatchStrategy.from_config(),
+    is_connected=is_online,
+    send=send_to,
+    still_searching=elder_still_searching,
+    assign=assign_volunteer)
+
+
+def volunteer_available(email: str):
+    # wakes parked searches, only for volunteers that can actually be matched
+    if email in volunteer_index:
+        matching_engine.volunteer_available(email)
+
+
+# every worker keeps its own volunteer index and principal cache, changes are applied
+# locally and published so the other workers apply them in listen_backend
+async def index_volunteer(email: str, lat: float, lon: float):
+    volunteer_index.add(email, lat, lon)
+    volunteer_available(email)
+    await backend.publish("volunteers", encode(
+        {"node": config.NODE_ID, "action": "add", "email": email, "lat": lat, "lon": lon}))
+
+
+async def move_volunteer(email: str, lat: float, lon: float):
+    volunteer_index.move(email, lat, lon)
+    volunteer_available(email)
+    await backend.publish("volunteers", encode(
+        {"node": config.NODE_ID, "action": "move", "email": email, "lat": lat, "lon": lon}))
+
+
+async def unindex_volunteer(email: str):
+    volunteer_index.remove(email)
+    await backend.publish("volunteers", encode({"node": config.NODE_ID, "action": "remove", "email": email}))
+
+
+async def invalidate_principal(email: str):
+    Autherize.principals.invalidate(email)
+    await backend.publish("principals", encode({"node": config.NODE_ID, "email": email}))
 
 
 @app.get("/ping")
@@ -60,12 +233,13 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 @app.post("/signup", response_model=UserBase)
 async def register(
-    user_data: Annotated[dict, Depends(get_user_data)]
+    user_data: Annotated[dict, Depends(get_user_data)],
+    session: Annotated[AsyncSession, Depends(Autherize.dep_session)]
 ) -> UserBase:
     try:
         profile_image: UploadFile = user_data["profile_image"] 
         profile_image = await Authent.authenticate_file(profile_image, 500 * 1024, ["jpg", "jpeg", "png"])
-        user_data["profile_image"] = profile_image
+        user_data["profile_image"] = await images.put(profile_image)
         user_data["volunteer_credits"] = 0
         user_create = UserCreate(**user_data)
 
@@ -73,7 +247,7 @@ async def register(
             user_type=user_create.user_type,
             full_name=user_create.full_name,
             email=user_create.email,
-            password=Authent.hash_password(user_create.password),
+            password=await Authent.hash_password_async(user_create.password),
             dob=user_create.dob,
             contact_number=user_create.contact_number,
             location=user_create.location,
@@ -84,20 +258,21 @@ async def register(
             institution=user_create.institution,
             approve=user_create.approve
         )
-        db.add_user(new_user)
+        await db.add_user(session, new_user)
         if new_user.user_type == "elder":
-            db.create_empty_elder_record(new_user)
+            await db.create_empty_elder_record(session, new_user)
             return new_user
+        await index_volunteer(new_user.email, new_user.latitude, new_user.longitude)
         return new_user
     except IntegrityError as e:
         print("DB Error: ", e)
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": "User already exist"}
         )
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -105,8 +280,11 @@ async def register(
 
 
 @app.post("/token")
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = Authent.authenticate_user(db, form_data.username, form_data.password)
+async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    try:
+        user = await Authent.authenticate_user(db, session, form_data.username, form_data.password)
+    except HashPoolFull as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -121,165 +299,328 @@ async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
 
 
 # websocket
-@app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+def websocket_user_token(websocket: WebSocket) -> str:
     token = websocket.query_params.get("token")
     if not token:
         raise HTTPException(status_code=401, detail="Token missing")
-    current_user = Autherize.dep_get_current_user(token)
-    await websocket.accept()
-    connected_clients[current_user.email] = websocket
+    return token
+
+
+def websocket_chat_cursor(websocket: WebSocket) -> int:
+    # optional id of the last stored chat message the client has, only newer unacked ones are replayed
+    try:
+        return int(websocket.query_params.get("after", 0))
+    except ValueError:
+        return 0
+
+
+async def on_load_aayi(current_user: UserBase, connection, response: dict):
+    for service_id, service in active_services.pending():
+        if current_user.email not in service["notified_volunteers"]:
+
+            connection.send(encoded_offer(service_id, service))
+            active_services.add_notified(service_id, current_user.email)
+
+
+async def on_volunteer_reply(current_user: UserBase, connection, response: dict):
+    if not volunteer_offers.resolve_reply(response["type"], current_user.email):
+        # the search may be running on another worker
+        await backend.publish("offer_replies", encode(
+            {"node": config.NODE_ID, "reply": response["type"], "email": current_user.email}))
+
+
+async def on_service_message(current_user: UserBase, connection, response: dict):
+    # no lock: a service's state is read and updated without awaiting in between, the
+    # pending -> accepted race is settled by an atomic claim and the sends go out afterwards
+    service_id = response["service_id"]
+    service = active_services.get(service_id)
+    outgoing = []
+    already_assigned = {
+        "type": "service_message",
+        "status": "not_assigned",
+        "service_id": service_id,
+        "message": "already_assigned",
+    }
+    if service is None:
+        outgoing.append((current_user.email, {"type": "service_not_found"}))
+
+    elif (service["status"] == ServiceStatus.PENDING and
+    response["status"] == ServiceStatus.ACCEPTED and
+    current_user.user_type == "volunteer"):
+        claimed = await backend.claim_service(service_id, current_user.email)
+        # re-read: a remote change applied while the claim was awaited may have replaced the dict
+        service = active_services.get(service_id)
+        if claimed and service is not None and service["status"] == ServiceStatus.PENDING:
+            active_services.update(
+                service_id,
+                volunteer_email=current_user.email,
+                volunteer_institution=current_user.institution,
+                status=ServiceStatus.ACCEPTED)
+            volunteer_profile = str_userbase(current_user)
+            outgoing.append((service["elder_email"], {
+                "type": "service_message",
+                "status": service["status"],
+                "service_id": service_id,
+                "message": "request_accepted",
+                "volunteer_profile": volunteer_profile
+            }))
+            outgoing.append((current_user.email, {
+                "type": "service_message",
+                "status": service["status"],
+                "service_id": service_id,
+                "message": "elder_request_accepted",
+                "volunteer_profile": volunteer_profile
+            }))
+        else:
+            outgoing.append((current_user.email, already_assigned))
+
+    elif service["status"] == ServiceStatus.ACCEPTED:
+        if current_user.user_type == "volunteer":
+            email_check = service["volunteer_email"]
+            partner_email = service["elder_email"]
+        else:
+            email_check = service["elder_email"]
+            partner_email = service["volunteer_email"]
+
+        if (response["message"] == "initial_request" or
+        email_check != current_user.email):
+            # only the assigned pair may move an accepted service on
+            outgoing.append((current_user.email, already_assigned))
+        else:
+            active_services.update(
+                service_id,
+                status=response["status"],
+                message=response["message"])
+            outgoing.append((partner_email, {
+                "type": "service_message",
+                "status": service["status"],
+                "service_id": service_id,
+                "message": service["message"]
+            }))
+
+    for email, message in outgoing:
+        await send_to(email, encode(message))
+
+
+# keyed by the part of "type" before the first ":", e.g. new_volunteer_request:accept:<elder>:<service_id>
+service_handlers = {
+    "load_aayi": on_load_aayi,
+    "new_volunteer_request": on_volunteer_reply,
+    "service_message": on_service_message,
+}
+
 
+async def on_service_event(current_user: UserBase, connection, response: dict):
+    handler = service_handlers.get(response["type"].split(":", 1)[0])
+    if handler is not None:
+        await handler(current_user, connection, response)
+
+
+async def chat_room(service_id: str):
+    """The participants of the pairing's or service's chat, empty while nobody is assigned."""
+    room = chat_rooms.get(service_id)
+    if room is not None:
+        return room
+    service = active_services.get(service_id)
+    if service is not None and "volunteer_email" in service:
+        return chat_rooms.open(service_id, (service["elder_email"], service["volunteer_email"]))
+    async with db.session_factory() as session:
+        participants = await db.chat_participants(session, service_id)
+    return chat_rooms.open(service_id, participants) if participants else frozenset()
+
+
+async def replay_chat(email: str, after: int, connection):
+    """Send the messages for ``email`` that were never acked, oldest first, from ``after`` on.
+
+    They stay "sent" until the client acks their message_id, so a message lost
+    on a dropped or closing socket is replayed again on the next connect.
+    """
+    await chat_writer.flush()  # this worker's buffered messages are unacked too
+    while True:
+        async with db.session_factory() as session:
+            rows = await db.undelivered_messages(session, email, after, config.CHAT_PAGE_MAX)
+        if not rows:
+            return
+        for row in rows:
+            connection.send(encode(row))
+        after = rows[-1]["id"]
+
+
+def chat_frame_error(response: dict) -> Optional[str]:
+    # checked before relaying, a row the database would refuse must not reach the writer
+    if response.get("type") == "ack":
+        message_ids = response.get("message_ids")
+        if not isinstance(message_ids, list) or not all(isinstance(i, str) for i in message_ids):
+            return "message_ids must be a list of strings"
+        return None
+    for field in ("service_id", "content", "timestamp"):
+        if not isinstance(response.get(field), str):
+            return f"{field} must be a string"
+    return None
+
+
+async def on_chat_message(current_user: UserBase, connection, response: dict):
+    email = current_user.email
+    error = chat_frame_error(response)
+    if error is not None:
+        connection.send(encode({"type": "error", "service_id": response.get("service_id"), "detail": error}))
+        return
+    if response.get("type") == "ack":
+        # {"type": "ack", "message_ids": [...]}, sent by the receiver for what it has shown
+        chat_writer.ack(email, response["message_ids"])
+        return
+    service_id = response["service_id"]
+    response["sender"] = email
+    room = await chat_room(service_id)
+    if email not in room:
+        connection.send(encode({"type": "error", "service_id": service_id,
+                                "detail": "not a participant of this service"}))
+        return
+    reciever = next(member for member in room if member != email)
+    response["reciever"] = reciever
+    response["message_id"] = uuid.uuid4().hex
+    response["status"] = ChatStatus.sent  # delivered once the receiver acks it
+    # relayed first, the writer journals it now and commits it with the next batch
+    await send_to(reciever, encode(response), "chat")
+    chat_writer.add(response)
+    connection.send(encode({"type": "receipt", "service_id": service_id,
+                            "timestamp": response["timestamp"], "message_id": response["message_id"],
+                            "status": response["status"]}))
+
+
+async def chat_connected(email: str, connection, after: int):
+    await client_connected("chat", email, connection)
+    await replay_chat(email, after, connection)
+
+
+async def chat_disconnected(email: str, connection):
+    await client_disconnected("chat", email, connection)
+    chat_rooms.leave(email, lambda member: is_online(member, "chat"))
+
+
+channel_handlers = {
+    "service": on_service_event,
+    "chat": on_chat_message,
+}
+
+
+@app.websocket("/connect")
+async def multiplexed_endpoint(websocket: WebSocket):
+    """Service events and chat over one socket.
+
+    Frames both ways are ``{"channel": "service" | "chat", "data": <message>}``,
+    where ``data`` is what /ws or /chat/{email} would send or receive.
+    """
+    token = websocket_user_token(websocket)
+    async with db.session_factory() as session:
+        current_user = await Autherize.dep_get_current_user(token, session)
+    after = websocket_chat_cursor(websocket)
+    await websocket.accept()
+    connection = connected_clients.open(websocket)
+    channels = {name: Channel(connection, name) for name in channel_handlers}
+    await client_connected("ws", current_user.email, channels["service"], presence_attrs(current_user))
+    volunteer_available(current_user.email)
     try:
+        await chat_connected(current_user.email, channels["chat"], after)
         while True:
-            response = await websocket.receive_json()
-            current_time = datetime.now()
-            # print("Websocket msg: ", response)
-            if response["type"] == "load_aayi":
-                    for service_id, service in active_services.items():
-
-                        timeout_end = datetime.strptime(
-                            service["timeout_end"], "%Y-%m-%d %H:%M:%S")
-
-                        if (service["status"] == ServiceStatus.PENDING and
-                        current_time < timeout_end and
-                        current_user.email not in service["notified_volunteers"]):
-
-                            request = {
-                                "type": "new_service_request",
-                                "service_id": service_id,
-                                "elder_profile": service["elder_profile"],
-                                "service_form": service["service_form"],
-                                "timeout": str(service["timeout_end"])
-                            }
-                            await websocket.send_text(json.dumps(request))
-                            service["notified_volunteers"].append(current_user.email)
-
-            if response["type"].startswith("new_volunteer_request"):
-                await new_volunteer_request_queue.put(response["type"])
-
-            # if response["type"].startswith("new_service_request"):
-            #     await new_service_request_queue.put(f"{response["type"]}:{current_user.email}")
-
-            if response["type"] == "service_message":
-                await lock.acquire()
-                service_id = response["service_id"]
-                if service_id in active_services:
-                    service = active_services[service_id]
-
-                    if (service["status"] == ServiceStatus.PENDING and
-                    response["status"] == ServiceStatus.ACCEPTED and
-                    current_user.user_type == "volunteer"):
-                            service["volunteer_email"] = current_user.email
-                            service["status"] = ServiceStatus.ACCEPTED
-                            print("HERE", connected_clients)
-                            if service["elder_email"] in connected_clients:
-                                await connected_clients[service["elder_email"]].send_text(json.dumps(
-                                    {
-                                        "type": "service_message",
-                                        "status": service["status"],
-                                        "service_id": service_id,
-                                        "message": "request_accepted",
-                                        "volunteer_profile": str_userbase(current_user)
-                                    }
-                                ))
-
-                            await connected_clients[current_user.email].send_text(json.dumps(
-                                {
-                                    "type": "service_message",
-                                    "status": service["status"],
-                                    "service_id": service_id,
-                                    "message": "elder_request_accepted",
-                                    "volunteer_profile": str_userbase(current_user)
-                                }
-                            ))
-
-                    elif service["status"] == ServiceStatus.ACCEPTED:
-                        if current_user.user_type == "volunteer":
-                            email_check = service["volunteer_email"]
-                            partner_email = service["elder_email"]
-                        else:
-                            email_check = service["elder_email"]
-                            partner_email = service["volunteer_email"]
-
-                        if (response["message"] == "initial_request" or
-                        email_check != current_user.email):
-                                await connected_clients[current_user.email].send_text(json.dumps(
-                                    {
-                                        "type": "service_message",
-                                        "status": "not_assigned",
-                                        "service_id": service_id,
-                                        "message": "already_assigned",
-                                    }
-                                ))
-
-                        if current_user.user_type == "volunteer":
-                            partner_email = service["elder_email"]
-                        else:
-                            partner_email = service["volunteer_email"]
-                        service["status"] = response["status"]
-                        service["message"] = response["message"]
-                        if partner_email in connected_clients:
-                            await connected_clients[partner_email].send_text(json.dumps(
-                                {
-                                    "type": "service_message",
-                                    "status": service["status"],
-                                    "service_id": service_id,
-                                    "message": service["message"]
-                                }
-                            ))
-                else:
-                    await websocket.send_text(json.dumps({"type":"service_not_found"}))
+            envelope = await websocket.receive_json()
+            name = envelope.get("channel")
+            if name not in channel_handlers:
+                connection.send(encode({"channel": "error", "data": {"type": "error", "detail": f"unknown channel {name}"}}))
+                continue
+            await channel_handlers[name](current_user, channels[name], envelope["data"])
+    except Exception as e:
+        print("ERROR: ", e)
+    finally:
+        connection.stop()
+        await client_disconnected("ws", current_user.email, channels["service"])
+        await chat_disconnected(current_user.email, channels["chat"])
 
-                lock.release()
 
+@app.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    token = websocket_user_token(websocket)
+    async with db.session_factory() as session:
+        current_user = await Autherize.dep_get_current_user(token, session)
+    await websocket.accept()
+    connection = connected_clients.open(websocket)
+    await client_connected("ws", current_user.email, connection, presence_attrs(current_user))
+    volunteer_available(current_user.email)
+
+    try:
+        while True:
+            await on_service_event(current_user, connection, await websocket.receive_json())
     except Exception as e:
         print("ERROR: ", e)
-        del connected_clients[current_user.email]
+        await client_disconnected("ws", current_user.email, connection)
 
 
 @app.websocket("/chat/{email}")
 async def chat_endpoint(websocket: WebSocket, email: str):
+    token = websocket_user_token(websocket)
+    async with db.session_factory() as session:
+        current_user = await Autherize.dep_get_current_user(token, session)
+    if current_user.email != email:
+        raise HTTPException(status_code=403, detail="Not your chat")
+    after = websocket_chat_cursor(websocket)
     await websocket.accept()
-    connected_clients_chat[email] = websocket
+    connection = connected_clients_chat.open(websocket)
     try:
+        await chat_connected(email, connection, after)
         while True:
-            response = await websocket.receive_json()
-            # print("content: ", response["content"])
-            # print("timestamp: ", response["timestamp"])
-            # print("service_id: ", response["service_id"])
-            # print("sender: ", response["sender"])
-            # print("reciever: ", response["reciever"])
-            # print("status: ", response["status"])
-            db.add_message(response)
-            if response["reciever"] in connected_clients_chat:
-                await connected_clients_chat[response["reciever"]] \
-                    .send_text(json.dumps(response))
+            await on_chat_message(current_user, connection, await websocket.receive_json())
     except Exception as e:
         print("ERROR: ", e)
+    finally:
+        await chat_disconnected(email, connection)
 
 
 # user endpoints
 @app.get("/user/messages/{service_id}")
-async def get_messages(service_id: str):
-    return db.session \
-        .query(ChatMessage).filter(ChatMessage.service_id == service_id).all()
+async def get_messages(
+        service_id: str, session: Annotated[AsyncSession, Depends(Autherize.dep_session)],
+        before: Optional[int] = None, after: Optional[int] = None,
+        limit: int = Query(config.CHAT_PAGE_SIZE, ge=1, le=config.CHAT_PAGE_MAX), format: str = "json"):
+    # pages are in id order; pass the first id as before= for older messages, the last as after= for newer
+    if format == "ndjson":
+        async def export():
+            async for row in db.iter_messages(service_id, config.CHAT_PAGE_MAX):
+                yield encode(row) + "\n"
+        return StreamingResponse(export(), media_type="application/x-ndjson")
+    if format != "json":
+        return JSONResponse(status_code=422, content={"detail": "format must be json or ndjson"})
+    return await db.get_messages(session, service_id, limit, before, after)
 
 
 @app.post("/admin/approve/{email}")
-async def approve_volunteer(email: str):
-    volunteer = db.session.query(UserModelDB).filter(
-        UserModelDB.email == email
-    ).first()
+async def approve_volunteer(email: str, session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    volunteer = await db.get_user_by_email(session, email)
 
     if not volunteer:
         return {"error": "Volunteer not found"}, 404
 
     volunteer.approve = True
-    db.session.commit()
+    await session.commit()
+    await invalidate_principal(email)
+    await update_presence(email, approve=True)
     return {"status": "approved"}
 
 
+@app.get("/images/{key}")
+async def get_image(key: str, request: Request):
+    # no token: the key is the content hash, unguessable, and <img> tags cannot send one
+    path = images.path(key)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers = {
+        "ETag": images.etag(key),
+        "Cache-Control": f"public, max-age={config.IMAGE_MAX_AGE}, immutable",
+    }
+    if images.etag(key) in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=images.media_type(key), headers=headers)
+
+
 @app.get("/user/get_institutions")
 async def get_institutions():
     ins = {}
@@ -301,10 +642,11 @@ async def know_your_partner(request: Annotated[Tuple[UserBase, UserBase, ElderRe
 @app.post("/user/update/{email}")
 async def update_profile(
     email: str,
-    user_data: Annotated[dict, Depends(update_user_data)]
+    user_data: Annotated[dict, Depends(update_user_data)],
+    session: Annotated[AsyncSession, Depends(Autherize.dep_session)]
 ):
     try:
-        user = db.get_user_by_email(email)
+        user = await db.get_user_by_email(session, email)
         if not user:
             raise ValueError("User not found")
 
@@ -314,8 +656,11 @@ async def update_profile(
         if user_data.get("contact_number"):
             user.contact_number = user_data["contact_number"]
 
+        location = None
         if user_data.get("location"):
+            location = Util.parse_location(user_data["location"])
             user.location = user_data["location"]
+            user.latitude, user.longitude = location
 
         if user_data.get("bio"):
             user.bio = user_data["bio"]
@@ -325,12 +670,15 @@ async def update_profile(
             profile_image = await Authent.authenticate_file(
                 profile_image, 500 * 1024, ["jpg", "jpeg", "png"]
             )
-            user.profile_image = profile_image
+            user.profile_image = await images.put(profile_image)
 
-        db.session.commit()
+        await session.commit()
+        await invalidate_principal(email)
+        if location is not None:
+            await move_volunteer(email, *location)
         return {"message": "updated"}
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -340,22 +688,21 @@ async def update_profile(
 @app.post("/user/feedback")
 async def feedback(
         feedback_form: Annotated[dict, Depends(get_feedback)],
-        current_user: Annotated[UserBase, Depends(Autherize.dep_get_current_user)]
+        current_user: Annotated[UserBase, Depends(Autherize.dep_get_current_user)],
+        session: Annotated[AsyncSession, Depends(Autherize.dep_session)]
     ):
     try:
         feedback_form["reporter_email"] = current_user.email
         feedback_db = Feedback(**feedback_form)
-        db.session.add(feedback_db)
-        db.session.commit()
+        session.add(feedback_db)
+        await session.commit()
 
-        for email, (name, password) in captain_institutions.items():
-            if email in connected_clients:
-                await connected_clients[email].send_text(json.dumps({
-                    "type": "new_feedback"
-                }))
+        await send_to_many(online["ws"].select(admin=True), encode({
+            "type": "new_feedback"
+        }))
         return {"message": "feedbacked sented"}
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -373,40 +720,38 @@ async def read_users_me(current_user: Annotated[UserBase, Depends(Autherize.dep_
 
 
 @app.post("/user/unassign")
-async def unassign(request: Annotated[Tuple[UserBase, UserBase, ElderRecord], Depends(Autherize.dep_elder_volunteer_linked)]):
-    _, _, record = request
+async def unassign(request: Annotated[Tuple[UserBase, UserBase, ElderRecord], Depends(Autherize.dep_elder_volunteer_linked)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    current_user, partner, record = request
+    volunteer = current_user if current_user.user_type == "volunteer" else partner
 
     response = {
         "type": "volunteer_service_message",
         "message": "unassign"
     }
 
-    if record.volunteer_email in connected_clients:
-        # print("volunteer present")
-        await connected_clients[record.volunteer_email].send_text(json.dumps(response))
-
-    if record.user_email in connected_clients:
-        # print("elder present")
-        await connected_clients[record.user_email].send_text(json.dumps(response))
+    await send_to_many((record.volunteer_email, record.user_email), encode(response))
 
     record.volunteer_email = None
     record.status = ElderStatus.not_assigned
-    db.session.commit()
+    await session.commit()
+    chat_rooms.close(record.service_id)  # the unassigned volunteer may not post to the elder anymore
+    if volunteer is not None:
+        await index_volunteer(volunteer.email, volunteer.latitude, volunteer.longitude)
 
     return {"message": "unassigned"}
 
 
 # elder endpoints
 @app.post("/elder/new_volunteer_request")
-async def new_volunteer_request(current_user: Annotated[UserBase, Depends(Autherize.dep_only_elder)]):
-    record = db.get_elder_record_by_email(current_user.email, current_user.user_type)
+async def new_volunteer_request(current_user: Annotated[UserBase, Depends(Autherize.dep_only_elder)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    record = await db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
     if record.status == ElderStatus.assigned:
         return {"message": "already_assigned"}
     if record.status == ElderStatus.searching_a_volunteer:
         return {"message": "already_searching"}
     if record.status == ElderStatus.not_assigned:
         record.status = ElderStatus.searching_a_volunteer
-        db.session.commit()
+        await session.commit()
         return {"message": ElderStatus.searching_a_volunteer}
     return {"message": "updated"}
 
@@ -417,6 +762,7 @@ async def new_service_request(
     urgent: bool,
     service_form: Annotated[ServiceRequestForm, Depends(ServiceRequestForm)],
     current_user: Annotated[UserBase, Depends(Autherize.dep_only_elder)],
+    session: Annotated[AsyncSession, Depends(Autherize.dep_session)],
         ):
 
     service_id = str(uuid.uuid4())
@@ -444,151 +790,121 @@ async def new_service_request(
                     buffer.write(file_bytes)
             service_form_text["documents"] = file_names
 
-        active_services[service_id] = {
+        elder_profile = str_userbase(current_user)
+        service = {
             "elder_email": current_user.email,
             "status": ServiceStatus.PENDING,
             "created_at": str(datetime.now()),
             "service_form": service_form_text,
             "notified_volunteers": [],
             "timeout_end": str(timeout_end),
-            "elder_profile": str_userbase(current_user)
-        }
-
-        volunteers = db.session.query(UserModelDB).filter(
-            UserModelDB.user_type == "volunteer"
-        ).all()
-
-        request = {
-            "type": "new_service_request",
-            "service_id": service_id,
-            "elder_profile": str_userbase(current_user),
-            "service_form": service_form_text,
-            "timeout": str(timeout_end),
+            "elder_profile": elder_profile
         }
 
-        for volunteer in volunteers:
-            if volunteer.email in connected_clients:
-                websocket = connected_clients[volunteer.email]
-                await websocket.send_text(json.dumps(request))
-                print(f"task with service id: {service_id} sent to {volunteer.email}")
-                active_services[service_id]["notified_volunteers"].append(volunteer.email)
-
-        db.session.add(
+        session.add(
             ServicesModel(
                 service_id=service_id,
-                data=json.dumps(active_services[service_id]))
+                data=encode(service))
         )
-        db.session.commit()
+        await session.commit()
+        # only once the row exists, so a failed request leaves nothing to offer
+        active_services.add(service_id, service)
+
+        # the elder gets the response now, volunteers are notified in the background
+        run_in_background(offer_service_to_volunteers(service_id))
 
         return {"status": "pending", "service_id": service_id}
 
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e), "service_id": service_id})
 
 
-# this will keep searching until a volunteer is found or timeout
+def encoded_offer(service_id: str, service: dict) -> str:
+    # the offer (with the elder's profile image) is encoded once and reused for every volunteer,
+    # its fields do not change after the service is created
+    text = offer_cache.get(service_id)
+    if text is None:
+        text = offer_cache[service_id] = encode({
+            "type": "new_service_request",
+            "service_id": service_id,
+            "elder_profile": service["elder_profile"],
+            "service_form": service["service_form"],
+            "timeout": str(service["timeout_end"])
+        })
+    return text
+
+
+async def offer_service_to_volunteers(service_id: str):
+    volunteers = online["ws"].select(user_type="volunteer")
+    service = active_services.get(service_id)
+    if service is None:
+        return
+    await send_to_many(volunteers, encoded_offer(service_id, service))
+    print(f"task with service id: {service_id} sent to {len(volunteers)} volunteers")
+    for email in volunteers:
+        if service_id in active_services:
+            active_services.add_notified(service_id, email)
+
+
+# starts (or joins) the background search for this elder and waits for it up to MATCH_LONG_POLL_SECONDS;
+# a 202 means it is still searching, poll again or wait for "volunteer_assigned" on /ws
 @app.get("/elder/find_assign_volunteer/{timeout}")
 async def find_assign_volunteer(
     timeout: float,
-    request: Annotated[
-        Tuple[UserBase, ElderRecord],
-        Depends(Autherize.dep_searching_volunteer),
-    ]
+    current_user: Annotated[UserBase, Depends(Autherize.dep_only_elder)],
+    session: Annotated[AsyncSession, Depends(Autherize.dep_session)],
 ):
+    record = await db.get_elder_record_by_email(session, current_user.email, current_user.user_type)
+    if record.status == ElderStatus.assigned:
+        # assigned by the background search since the previous poll
+        return JSONResponse(
+            status_code=200,
+            content={"detail": "Volunteer assigned successfully", "service_id": record.service_id},
+        )
+    if record.status != ElderStatus.searching_a_volunteer:
+        raise Autherize.auth_exception("not requested for searching")
+    await session.close()  # not needed while waiting on the search, give the connection back
+    search = matching_engine.start_search(current_user, timeout)
     try:
-        service_id = str(uuid.uuid4())
-        current_user, record = request
-        lat1, lon1 = map(float, current_user.location.split(","))
-
-        while True:
-            volunteers = db.get_unassigned_volunteers()
-
-            if not volunteers:
-                return JSONResponse(
-                    status_code=422, content={"detail": "No active volunteers"}
-                )
-
-            lat1, lon1 = map(float, current_user.location.split(","))
-            potential_volunteers = []
-
-            for volunteer in volunteers:
-                lat2, lon2 = map(float, volunteer.location.split(","))
-                curr_dist = Util.calculate_distance(lat1, lon1, lat2, lon2)
-                potential_volunteers.append((curr_dist, volunteer))
-
-            potential_volunteers = sorted(potential_volunteers, key=lambda x: x[0])
-            print("connected clinets = ", connected_clients)
-
-            while potential_volunteers:
-                Autherize.dep_searching_volunteer(current_user)
-
-                _, volunteer = potential_volunteers.pop(0)
-
-                if volunteer.email in connected_clients:
-                    websocket = connected_clients[volunteer.email]
-
-                    try:
-                        # Send a request to the volunteer and wait for response
-                        request = {
-                            "type": "new_volunteer_request",
-                            "elder_profile": str_userbase(current_user),
-                            "timeout": timeout,
-                            "service_id": service_id
-                        }
-                        await websocket.send_text(json.dumps(request))
-                        message = await asyncio.wait_for(new_volunteer_request_queue.get(), timeout=timeout)
-                        new_volunteer_request_queue.task_done()
-                        message = message.split(":")
-                        if message[1] == "accept" and message[2] == current_user.email and message[3] == service_id:
-                            record.volunteer_email = volunteer.email
-                            record.status = ElderStatus.assigned
-                            record.service_id = service_id
-                            db.session.commit()
-                            return JSONResponse(
-                                status_code=200,
-                                content={"detail": "Volunteer assigned successfully", "service_id": service_id},
-                            )
-                    except Exception:
-                        # Handle connection or other errors
-                        # return JSONResponse(
-                        #     status_code=422,
-                        #     content={"detail": str(e)},
-                        # )
-                        continue
-            # If no volunteer accepts, return a failure response
-            # return JSONResponse(
-            #     status_code=422,
-            #     content={"detail": "No volunteers accepted the request"},
-            # )
-            # print("IT's running")
-            await asyncio.sleep(5)
-
+        volunteer_email = await asyncio.wait_for(
+            asyncio.shield(search.result), timeout=config.MATCH_LONG_POLL_SECONDS)
+    except asyncio.TimeoutError:
+        return JSONResponse(
+            status_code=202,
+            content={"detail": "Searching for a volunteer", "service_id": search.service_id},
+        )
     except Exception as e:
-        db.session.rollback()
         return JSONResponse(status_code=422, content={"detail": str(e)})
 
+    if volunteer_email is None:
+        return JSONResponse(status_code=422, content={"detail": "Not searching for a volunteer anymore"})
+    return JSONResponse(
+        status_code=200,
+        content={"detail": "Volunteer assigned successfully", "service_id": search.service_id},
+    )
+
 
 @app.get("/elder/record")
-async def record(user: Annotated[UserBase, Depends(Autherize.dep_only_elder)]):
-    return db.get_elder_record_by_email(user.email, user.user_type)
+async def record(user: Annotated[UserBase, Depends(Autherize.dep_only_elder)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    return await db.get_elder_record_by_email(session, user.email, user.user_type)
 
 
 # volunteer endpoints
 
 @app.get("/volunteer/can_assign/{email}")
-async def can_assign(email: str):
+async def can_assign(email: str, session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        record: ElderRecord = db.get_elder_record_by_email(email, "elder")
+        record: ElderRecord = await db.get_elder_record_by_email(session, email, "elder")
         print(record.status)
         if (record.status != "assigned"):
             return {"status": True}
         else:
             return JSONResponse(status_code=422, content={"status": False})
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -597,14 +913,15 @@ async def can_assign(email: str):
 
 @app.post("/volunteer/update_record")
 async def update_record(
-        request: Annotated[Tuple[dict, ElderRecord, UserModelDB], Depends(Autherize.dep_update_record)]):
+        request: Annotated[Tuple[dict, ElderRecord, UserBase], Depends(Autherize.dep_update_record)],
+        session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
         record_form, record, volunteer = request
         record.data = record_form["data"]
         record.last_check_in = datetime.now()
-        volunteer.volunteer_credits += 50
+        await db.add_volunteer_credits(session, volunteer.email, 50)
 
-        db.session.add(WeekendRecord(
+        session.add(WeekendRecord(
             service_id=record.service_id,
             user_email=record.user_email,
             volunteer_email=record.volunteer_email,
@@ -613,30 +930,20 @@ async def update_record(
             status=record.status
         ))
 
-        db.session.commit()
+        await session.commit()
+        await invalidate_principal(volunteer.email)
 
-        if record.user_email in connected_clients:
-            await connected_clients[record.user_email].send_text(json.dumps({
-                "type": "volunteer_service",
-                "message": "record_updated"
-            }))
+        await send_to_many((record.user_email, record.volunteer_email), encode({
+            "type": "volunteer_service",
+            "message": "record_updated"
+        }))
 
-        if record.volunteer_email in connected_clients:
-            await connected_clients[record.volunteer_email].send_text(
-                json.dumps({
-                    "type": "volunteer_service",
-                    "message": "record_updated"
-                }))
-
-        for email, (name, password) in captain_institutions.items():
-            if email in connected_clients:
-                await connected_clients[email].send_text(
-                    json.dumps({"message": "record_updated"}))
+        await send_to_many(online["ws"].select(admin=True), encode({"message": "record_updated"}))
 
         return {"message": "updated"}
 
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -644,12 +951,12 @@ async def update_record(
 
 
 @app.get("/volunteer/get_documents/{service_id}/{document}")
-async def update_record(service_id: str, document: str, token: str = Query(...)):
+async def update_record(service_id: str, document: str, session: Annotated[AsyncSession, Depends(Autherize.dep_session)], token: str = Query(...)):
 
     if not token:
         raise HTTPException(status_code=401, detail="Token missing")
 
-    current_user = Autherize.dep_get_current_user(token)
+    current_user = await Autherize.dep_get_current_user(token, session)
     current_user = Autherize.dep_only_volunteer(current_user)
 
     try:
@@ -673,7 +980,7 @@ async def update_record(service_id: str, document: str, token: str = Query(...))
         return FileResponse(file, status_code=200, media_type="application/octet-stream",filename=filename)
 
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -682,12 +989,12 @@ async def update_record(service_id: str, document: str, token: str = Query(...))
 
 # admin endpoints
 @app.get("/admin/records")
-async def get_users(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def get_users(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        records = db.session.query(ElderRecord).all()
+        records = (await session.execute(select(ElderRecord))).scalars().all()
         return records
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -695,15 +1002,15 @@ async def get_users(current_user: Annotated[UserBase, Depends(Autherize.dep_only
 
 
 @app.get("/admin/users/{email}")
-async def get_users_email(email: str):
+async def get_users_email(email: str, session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        user = db.get_user_by_email(email)
+        user = await db.get_user_by_email(session, email)
         if user is not None:
             return user
         else:
             raise HTTPException(status_code=422, detail="User not found")
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -711,12 +1018,12 @@ async def get_users_email(email: str):
 
 
 @app.get("/admin/get_all_users")
-async def get_all_users(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def get_all_users(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        users = db.session.query(UserModelDB).all()
+        users = (await session.execute(select(UserModelDB))).scalars().all()
         return users
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -724,12 +1031,12 @@ async def get_all_users(current_user: Annotated[UserBase, Depends(Autherize.dep_
 
 
 @app.get("/admin/users")
-async def get_users_acc(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def get_users_acc(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        users = db.session.query(UserModelDB).all()
+        users = (await session.execute(select(UserModelDB))).scalars().all()
         return users
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -737,9 +1044,9 @@ async def get_users_acc(current_user: Annotated[UserBase, Depends(Autherize.dep_
 
 
 @app.delete("/admin/delete/{email}")
-async def delete_user(email: str, current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def delete_user(email: str, current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        user = db.get_user_by_email(email)
+        user = await db.get_user_by_email(session, email)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -747,18 +1054,31 @@ async def delete_user(email: str, current_user: Annotated[UserBase, Depends(Auth
             if user.email == email:
                 raise HTTPException(status_code=404, detail="do you hate your life")
 
-        record = db.get_elder_record_by_email(user.email, user.user_type)
+        freed_volunteer = None
+        closed_room = None
+        record = await db.get_elder_record_by_email(session, user.email, user.user_type)
         if record is not None:
+            closed_room = record.service_id
             if user.user_type == "elder":
-                db.session.delete(record)
+                if record.status == ElderStatus.assigned:
+                    freed_volunteer = record.volunteer_email
+                await session.delete(record)
             else:
                 record.status = ElderStatus.not_assigned
                 record.volunteer_email = None
-        db.session.delete(user)
-        db.session.commit()
+        await session.delete(user)
+        await session.commit()
+        await invalidate_principal(user.email)
+        await unindex_volunteer(user.email)
+        if closed_room is not None:
+            chat_rooms.close(closed_room)
+        if freed_volunteer is not None:
+            volunteer = await db.get_user_by_email(session, freed_volunteer)
+            if volunteer is not None:
+                await index_volunteer(volunteer.email, volunteer.latitude, volunteer.longitude)
         return {"message": f"User with email {email} deleted successfully"}
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -766,12 +1086,12 @@ async def delete_user(email: str, current_user: Annotated[UserBase, Depends(Auth
 
 
 @app.get("/admin/feedback")
-async def get_users_feedback(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def get_users_feedback(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        feedbacks = db.session.query(Feedback).all()
+        feedbacks = (await session.execute(select(Feedback))).scalars().all()
         return feedbacks
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(
             status_code=422,
             content={"detail": str(e)}
@@ -779,72 +1099,189 @@ async def get_users_feedback(current_user: Annotated[UserBase, Depends(Autherize
 
 
 @app.put("/admin/feedback/review/{id}")
-async def feedback_reviewed(id: int, current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+async def feedback_reviewed(id: int, current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)], session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
     try:
-        feedbacks = db.session.query(Feedback).filter(
-            Feedback.id == id
-        ).all()
+        stmt = select(Feedback).where(Feedback.id == id)
+        feedbacks = (await session.execute(stmt)).scalars().all()
 
         if not feedbacks:
             raise HTTPException(status_code=422, detail="No feedback found for this email")
 
         for feedback in feedbacks:
             feedback.status = "reviewed"
-        db.session.commit()
+        await session.commit()
         return {"message": "updated"}
     except Exception as e:
-        db.session.rollback()
+        await session.rollback()
         return JSONResponse(status_code=422, content={"detail": str(e)})
 
 
+@app.get("/admin/metrics")
+async def get_metrics(current_user: Annotated[UserBase, Depends(Autherize.dep_only_admin)]):
+    return {
+        "hash_pool": Authent.hash_pool.stats(),
+        "principal_cache": Autherize.principals.stats(),
+        "active_services": active_services.stats(),
+        "websockets": connected_clients.stats(),
+        "online": online["ws"].stats(),
+        "chat_websockets": connected_clients_chat.stats(),
+        "chat_writer": chat_writer.stats(),
+        "chat_rooms": chat_rooms.stats(),
+    }
+
+
 @app.get("/admin/get_services")
-async def get_services():
-    service_forms: ServicesModel = db.session.query(ServicesModel).all()
+async def get_services(session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    service_forms: ServicesModel = (await session.execute(select(ServicesModel))).scalars().all()
     return service_forms
 
 
 @app.get("/admin/get_weekend_records")
-async def get_weekend_records():
-    records = db.session.query(WeekendRecord).all()
+async def get_weekend_records(session: Annotated[AsyncSession, Depends(Autherize.dep_session)]):
+    records = (await session.execute(select(WeekendRecord))).scalars().all()
     return records
 
 
 @app.on_event("startup")
 async def startup_event():
     """Start the background monitoring task on FastAPI startup."""
-    asyncio.create_task(watch_dict())
-
-
-async def watch_dict():
-    previous_state = copy.deepcopy(active_services)
-    while True:
-        await asyncio.sleep(1)
-        if active_services != previous_state:
-            print("Change detected! Running function...")
-            await on_change()
-            previous_state = copy.deepcopy(active_services)
-
-
-async def on_change():
-    service_forms: ServicesModel = db.session.query(ServicesModel).all()
-    for forms in service_forms:
-        if forms.service_id in active_services:
-            forms.data = json.dumps(active_services[forms.service_id])
-    db.session.commit()
-    for email, (name, password) in captain_institutions.items():
-        if email in connected_clients:
-            await connected_clients[email].send_text(
-                json.dumps({"message": "task_updated"}))
-
-    for forms in service_forms:
-        if forms.service_id in active_services:
-            if active_services[forms.service_id]["elder_email"] in connected_clients:
-                elder_email = active_services[forms.service_id]["elder_email"]
-                await connected_clients[elder_email].send_text(
-                    json.dumps({"message": "task_updated"}))
-
-            if "volunteer_email" in active_services[forms.service_id]:
-                volunteer_email = active_services[forms.service_id]["volunteer_email"]
-                if volunteer_email in connected_clients:
-                    await connected_clients[volunteer_email].send_text(
-                        json.dumps({"message": "task_updated"}))
+    if config.DB_SETUP_ON_STARTUP:
+        await asyncio.to_thread(setup_schema)
+    await db.setup()
+    await chat_writer.start()
+    async with db.session_factory() as session:
+        for volunteer in await db.get_unassigned_volunteers(session):
+            if volunteer.latitude is not None:
+                volunteer_index.add(volunteer.email, volunteer.latitude, volunteer.longitude)
+    # pick up what the other workers already hold
+    for service_id, fields in (await backend.services()).items():
+        active_services.apply(service_id, {field: decode(value) for field, value in fields.items()})
+    for key, (node, attrs) in (await backend.presence()).items():
+        kind, email = key.split(":", 1)
+        online[kind].add(email, node, attrs)
+    background_tasks.extend([
+        asyncio.create_task(watch_services()),
+        asyncio.create_task(active_services.run_expiry()),
+        asyncio.create_task(listen_backend()),
+        asyncio.create_task(chat_writer.run())])
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    matching_engine.stop()
+    for task in background_tasks:
+        task.cancel()
+    await chat_writer.close()
+    await backend.close()
+
+
+background_tasks = []
+
+
+async def listen_backend():
+    """Apply events published by the other workers."""
+    channels = (f"node:{config.NODE_ID}", "presence", "services", "offer_replies", "volunteers", "principals")
+    async for channel, message in backend.subscribe(*channels):
+        try:
+            event = decode(message)
+            if channel == f"node:{config.NODE_ID}":
+                local_clients[event["kind"]].broadcast(event["emails"], event["text"])
+            elif event["node"] == config.NODE_ID:
+                continue
+            elif channel == "presence":
+                if event["owner"] is not None:
+                    online[event["kind"]].add(event["email"], event["owner"], event["attrs"])
+                    if event["kind"] == "ws":
+                        volunteer_available(event["email"])
+                else:
+                    online[event["kind"]].remove(event["email"], event["node"])
+            elif channel == "services":
+                await apply_remote_service(event["service_id"], event["fields"])
+            elif channel == "offer_replies":
+                volunteer_offers.resolve_reply(event["reply"], event["email"])
+            elif channel == "volunteers":
+                if event["action"] == "add":
+                    volunteer_index.add(event["email"], event["lat"], event["lon"])
+                elif event["action"] == "move":
+                    volunteer_index.move(event["email"], event["lat"], event["lon"])
+                else:
+                    volunteer_index.remove(event["email"])
+                # searches running here may now offer the volunteer
+                volunteer_available(event["email"])
+            elif channel == "principals":
+                Autherize.principals.invalidate(event["email"])
+        except Exception as e:
+            print("ERROR: ", e)
+
+
+async def replicate_services(service_ids, deltas: Dict[str, dict]):
+    # only the fields this worker changed, so a stale copy here cannot undo another worker's change
+    for service_id in service_ids:
+        fields = deltas.get(service_id) if service_id in active_services else None
+        if fields is None:
+            await backend.delete_service(service_id)
+        else:
+            await backend.put_service(service_id, {field: encode(value) for field, value in fields.items()})
+        await backend.publish("services", encode(
+            {"node": config.NODE_ID, "service_id": service_id, "fields": fields}))
+
+
+async def apply_remote_service(service_id: str, fields: Optional[dict]):
+    if fields is None:
+        active_services.apply(service_id, None)
+        offer_cache.pop(service_id, None)
+    elif not active_services.apply_fields(service_id, fields):
+        # not held here yet (created elsewhere before this worker subscribed), take the whole record
+        stored = await backend.service(service_id)
+        if stored is not None:
+            active_services.apply(service_id, {field: decode(value) for field, value in stored.items()})
+
+
+async def watch_services():
+    async for changes in active_services.changes():
+        try:
+            # the changed fields of each service, for the database, the clients and the other workers
+            deltas = {service_id: {field: active_services[service_id][field]
+                                   for field in fields if field in active_services[service_id]}
+                      for service_id, fields in changes.items() if service_id in active_services}
+            try:
+                await on_change(deltas)
+            except Exception as e:
+                # e.g. "database is locked": keep the batch dirty so it is saved, and evicted, later
+                print("ERROR: ", e)
+                active_services.restore_changes(changes)
+                await asyncio.sleep(config.SERVICE_SAVE_RETRY)
+                continue
+            # finished services are in the database now, drop them from memory
+            for service_id in active_services.evict_finished(changes):
+                offer_cache.pop(service_id, None)
+            await replicate_services(changes, deltas)
+        except Exception as e:
+            print("ERROR: ", e)
+
+
+def service_audience(service: dict) -> Set[str]:
+    """The elder, the assigned volunteer and the captains of their institutions."""
+    audience = {service["elder_email"]}
+    if "volunteer_email" in service:
+        audience.add(service["volunteer_email"])
+    for institution in (service["elder_profile"]["institution"], service.get("volunteer_institution")):
+        if institution is not None:
+            audience.update(online["ws"].select(admin=True, institution=institution))
+    return audience
+
+
+async def on_change(deltas: Dict[str, dict]):
+    async with db.session_factory() as session:
+        await db.save_service_data(session, deltas)
+
+    for service_id, fields in deltas.items():
+        service = active_services.get(service_id)
+        if service is None:
+            continue
+        # only the changed fields, clients patch their copy instead of re-fetching /admin/get_services
+        await send_to_many(service_audience(service), encode({
+            "message": "task_updated",
+            "service_id": service_id,
+            "changes": fields
+        }))
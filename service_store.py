@@ -0,0 +1,198 @@
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+from model import ServiceStatus
+import asyncio
+import heapq
+
+FINISHED = {ServiceStatus.COMPLETED.value, ServiceStatus.ABORTED.value, ServiceStatus.EXPIRED.value}
+
+
+def status_key(status) -> str:
+    # ServiceStatus members and the plain strings sent by clients index the same bucket
+    return getattr(status, "value", status)
+
+
+def parse_deadline(value: str) -> datetime:
+    """timeout_end as aware UTC; naive values are the server's local time."""
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ServiceStore:
+    """In-memory active services that record what changed.
+
+    Reads work like a dict (``in``, ``[]``, ``get``, ``items``); writes must go
+    through ``add``/``update``/``add_notified`` so the store knows which services
+    and fields changed. ``changes()`` yields those batches as soon as they happen,
+    replacing the old copy-and-compare polling.
+
+    Services are also indexed by status, and pending ones sit in a heap keyed on
+    ``timeout_end``: ``run_expiry()`` marks them expired when the deadline passes.
+    Finished services are dropped with ``evict_finished`` once they are persisted.
+    """
+
+    def __init__(self):
+        self.services: Dict[str, dict] = {}
+        self.dirty: Dict[str, Set[str]] = {}
+        self.changed = asyncio.Event()
+        self.by_status: Dict[str, Set[str]] = {}
+        self.deadlines: Dict[str, datetime] = {}
+        self.expiry: List[Tuple[datetime, str]] = []
+        self.rescheduled = asyncio.Event()
+
+    def __contains__(self, service_id: str):
+        return service_id in self.services
+
+    def __getitem__(self, service_id: str) -> dict:
+        return self.services[service_id]
+
+    def __len__(self):
+        return len(self.services)
+
+    def get(self, service_id: str, default=None):
+        return self.services.get(service_id, default)
+
+    def items(self):
+        return self.services.items()
+
+    def pending(self) -> Iterator[Tuple[str, dict]]:
+        """Pending services whose timeout_end has not passed yet."""
+        for service_id in list(self.by_status.get(ServiceStatus.PENDING.value, ())):
+            deadline = self.deadlines.get(service_id)
+            if deadline is None or utc_now() < deadline:
+                yield service_id, self.services[service_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {status: len(ids) for status, ids in self.by_status.items()}
+
+    def index_status(self, service_id: str, old, new):
+        if old is not None:
+            ids = self.by_status.get(status_key(old))
+            if ids is not None:
+                ids.discard(service_id)
+                if not ids:
+                    del self.by_status[status_key(old)]
+        if new is not None:
+            self.by_status.setdefault(status_key(new), set()).add(service_id)
+
+    def mark(self, service_id: str, fields: Iterable[str]):
+        self.dirty.setdefault(service_id, set()).update(fields)
+        self.changed.set()
+
+    def add(self, service_id: str, service: dict):
+        # parsed before any state changes, a bad timeout_end leaves the store untouched
+        deadline = parse_deadline(service["timeout_end"]) if "timeout_end" in service else None
+        old = self.services.get(service_id)
+        self.services[service_id] = service
+        self.index_status(service_id, old.get("status") if old else None, service.get("status"))
+        if deadline is not None:
+            self.deadlines[service_id] = deadline
+            if not self.expiry or deadline < self.expiry[0][0]:
+                self.rescheduled.set()
+            heapq.heappush(self.expiry, (deadline, service_id))
+        self.mark(service_id, service.keys())
+
+    def update(self, service_id: str, **fields):
+        service = self.services[service_id]
+        if "status" in fields:
+            self.index_status(service_id, service.get("status"), fields["status"])
+        service.update(fields)
+        self.mark(service_id, fields.keys())
+
+    def add_notified(self, service_id: str, email: str):
+        self.services[service_id]["notified_volunteers"].append(email)
+        self.mark(service_id, ("notified_volunteers",))
+
+    def apply(self, service_id: str, service: Optional[dict]):
+        """Take another worker's copy of a service (None once it was evicted there)
+        without marking it changed; the worker that changed it persists it."""
+        deadline = None
+        if service is not None and "timeout_end" in service:
+            deadline = parse_deadline(service["timeout_end"])
+        old = self.services.pop(service_id, None)
+        self.index_status(service_id, old.get("status") if old else None, None)
+        self.deadlines.pop(service_id, None)
+        if service is None:
+            return
+        self.services[service_id] = service
+        self.index_status(service_id, None, service.get("status"))
+        if deadline is not None:
+            # only used to filter pending(), the worker that created the service expires it
+            self.deadlines[service_id] = deadline
+
+    def apply_fields(self, service_id: str, fields: dict) -> bool:
+        """Merge the fields another worker changed into the local copy, without
+        marking them; returns False when the service is not held here."""
+        old = self.services.get(service_id)
+        if old is None:
+            return False
+        self.apply(service_id, {**old, **fields})
+        return True
+
+    def expire(self) -> List[str]:
+        """Mark pending services whose timeout_end passed as expired."""
+        expired = []
+        while self.expiry:
+            deadline, service_id = self.expiry[0]
+            if utc_now() < deadline:
+                break
+            heapq.heappop(self.expiry)
+            # heap entries are not removed when a service is accepted or evicted, skip stale ones
+            if self.deadlines.get(service_id) != deadline:
+                continue
+            del self.deadlines[service_id]
+            service = self.services.get(service_id)
+            if service is not None and status_key(service["status"]) == ServiceStatus.PENDING.value:
+                self.update(service_id, status=ServiceStatus.EXPIRED)
+                expired.append(service_id)
+        return expired
+
+    async def run_expiry(self):
+        while True:
+            self.expire()
+            self.rescheduled.clear()
+            delay = None
+            if self.expiry:
+                deadline = self.expiry[0][0]
+                delay = max((deadline - utc_now()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self.rescheduled.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def evict_finished(self, service_ids: Iterable[str]) -> List[str]:
+        """Drop finished services, except ones changed again since they were persisted."""
+        evicted = []
+        for service_id in service_ids:
+            service = self.services.get(service_id)
+            if (service is None or service_id in self.dirty or
+                    status_key(service["status"]) not in FINISHED):
+                continue
+            del self.services[service_id]
+            self.deadlines.pop(service_id, None)
+            self.index_status(service_id, service["status"], None)
+            evicted.append(service_id)
+        return evicted
+
+    def restore_changes(self, changes: Dict[str, Set[str]]):
+        """Put back a batch from take_changes() that could not be persisted, to be retried."""
+        for service_id, fields in changes.items():
+            if service_id in self.services:
+                self.mark(service_id, fields)
+
+    def take_changes(self) -> Dict[str, Set[str]]:
+        changes, self.dirty = self.dirty, {}
+        self.changed.clear()
+        return changes
+
+    async def changes(self) -> AsyncIterator[Dict[str, Set[str]]]:
+        """Yield {service_id: changed fields} batches; mutations made while a batch
+        is being handled are coalesced into the next one."""
+        while True:
+            await self.changed.wait()
+            changes = self.take_changes()
+            if changes:
+                yield changes
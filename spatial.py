@@ -0,0 +1,139 @@
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from math import cos, floor, radians
+import heapq
+from util import Util
+
+KM_PER_DEG = 111.195  # great circle km per degree of latitude (R = 6371 km)
+
+
+def bounding_box(lat: float, lon: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """(min_lat, max_lat, min_lon, max_lon) that contains every point within radius_km."""
+    lat_span = radius_km / KM_PER_DEG
+    lon_span = radius_km / (KM_PER_DEG * max(cos(radians(min(abs(lat) + lat_span, 89.9))), 1e-6))
+    return lat - lat_span, lat + lat_span, lon - lon_span, lon + lon_span
+
+
+class VolunteerIndex:
+    """Uniform lat/lon grid of available volunteers.
+
+    Points are bucketed into cells of ``cell_deg`` degrees. Nearest queries expand
+    ring by ring around the origin cell and stop as soon as the best pending
+    candidate is closer than anything an unvisited ring could hold, so only the
+    neighbourhood of the origin is scanned.
+    """
+
+    def __init__(self, cell_deg: float = 0.1):
+        self.cell_deg = cell_deg
+        self.cells: Dict[Tuple[int, int], Set[str]] = {}
+        self.points: Dict[str, Tuple[float, float]] = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def __contains__(self, email: str):
+        return email in self.points
+
+    def cell_of(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (floor(lat / self.cell_deg), floor(lon / self.cell_deg))
+
+    def add(self, email: str, lat: float, lon: float):
+        self.remove(email)
+        self.points[email] = (lat, lon)
+        self.cells.setdefault(self.cell_of(lat, lon), set()).add(email)
+
+    def remove(self, email: str):
+        point = self.points.pop(email, None)
+        if point is None:
+            return
+        cell = self.cell_of(*point)
+        members = self.cells[cell]
+        members.discard(email)
+        if not members:
+            del self.cells[cell]
+
+    def move(self, email: str, lat: float, lon: float):
+        # only volunteers that are currently available are tracked
+        if email in self.points:
+            self.add(email, lat, lon)
+
+    def ring(self, center: Tuple[int, int], r: int) -> Iterator[Tuple[int, int]]:
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for dj in range(-r, r + 1):
+            yield (ci - r, cj + dj)
+            yield (ci + r, cj + dj)
+        for di in range(-r + 1, r):
+            yield (ci + di, cj - r)
+            yield (ci + di, cj + r)
+
+    def ring_lower_bound_km(self, lat: float, r: int) -> float:
+        # anything outside rings 0..r is more than r cells away along lat or lon
+        span = r * self.cell_deg
+        lon_scale = cos(radians(min(abs(lat) + span, 89.9)))
+        return span * KM_PER_DEG * lon_scale
+
+    def distances(self, lat: float, lon: float, emails: List[str]):
+        points = [self.points[email] for email in emails]
+        lats = [point[0] for point in points]
+        lons = [point[1] for point in points]
+        return Util.calculate_distances(lat, lon, lats, lons).tolist()
+
+    def push_cells(self, heap: List[Tuple[float, str]], cells, lat: float, lon: float):
+        emails = [email for cell in cells for email in self.cells.get(cell, ())]
+        if emails:
+            for dist, email in zip(self.distances(lat, lon, emails), emails):
+                heapq.heappush(heap, (dist, email))
+
+    def iter_nearest(self, lat: float, lon: float, max_km: Optional[float] = None) -> Iterator[Tuple[float, str]]:
+        """Yield (distance_km, email) in increasing distance, lazily."""
+        ci, cj = center = self.cell_of(lat, lon)
+        heap: List[Tuple[float, str]] = []
+        r = 0
+        swept = False
+        while True:
+            if 8 * r > len(self.cells):
+                # the ring is now bigger than the occupied grid, finish with one pass over what is left
+                rest = [c for c in self.cells if max(abs(c[0] - ci), abs(c[1] - cj)) >= r]
+                self.push_cells(heap, rest, lat, lon)
+                swept = True
+                bound = float("inf")
+            else:
+                self.push_cells(heap, self.ring(center, r), lat, lon)
+                bound = self.ring_lower_bound_km(lat, r)
+                r += 1
+
+            while heap and heap[0][0] <= bound:
+                dist, email = heapq.heappop(heap)
+                if max_km is not None and dist > max_km:
+                    return
+                if email in self.points:
+                    yield dist, email
+            if swept or (max_km is not None and bound > max_km):
+                return
+
+    def nearest(self, lat: float, lon: float, k: int, max_km: Optional[float] = None) -> List[Tuple[float, str]]:
+        result = []
+        for item in self.iter_nearest(lat, lon, max_km):
+            result.append(item)
+            if len(result) >= k:
+                break
+        return result
+
+    def within(self, lat: float, lon: float, radius_km: float) -> List[Tuple[float, str]]:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+        i0, j0 = self.cell_of(min_lat, min_lon)
+        i1, j1 = self.cell_of(max_lat, max_lon)
+        emails = []
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            cells = [c for c in self.cells if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
+        else:
+            cells = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        for cell in cells:
+            emails.extend(self.cells.get(cell, ()))
+        if not emails:
+            return []
+        found = [(dist, email) for dist, email in zip(self.distances(lat, lon, emails), emails) if dist <= radius_km]
+        found.sort()
+        return found
@@ -0,0 +1,28 @@
+import os
+import sys
+import pytest
+
+# the modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(tmp_path, monkeypatch):
+    from db_init import setup_schema
+    from db_op import DB
+    url = f"sqlite:///{tmp_path / 'amanah.db'}"
+    monkeypatch.setattr(config, "DATABASE_URL", url)
+    monkeypatch.setattr(config, "DB_ECHO", False)
+    monkeypatch.setattr(config, "DB_SETUP_LOCK", str(tmp_path / "db_setup.lock"))
+    monkeypatch.setattr(config, "BLOB_DIR", str(tmp_path / "blobs"))
+    setup_schema(url)
+    db = DB()
+    yield db
+    await db.engine.dispose()
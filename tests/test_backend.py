@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from backend import MemoryBackend, RedisBackend
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["memory", "redis"])
+async def backend(request):
+    if request.param == "memory":
+        backend = MemoryBackend()
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        backend = RedisBackend(fakeredis.aioredis.FakeRedis(), prefix="test")
+    yield backend
+    await backend.close()
+
+
+async def test_presence_is_cleared_only_by_its_owner(backend):
+    await backend.set_presence("ws:a@x.com", "n1", {"user_type": "volunteer"})
+    await backend.set_presence("ws:a@x.com", "n2", {"user_type": "volunteer"})  # reconnected elsewhere
+    await backend.clear_presence("ws:a@x.com", "n1")
+    assert await backend.presence() == {"ws:a@x.com": ("n2", {"user_type": "volunteer"})}
+    await backend.clear_presence("ws:a@x.com", "n2")
+    assert await backend.presence() == {}
+
+
+async def test_put_service_merges_fields(backend):
+    await backend.put_service("s1", {"status": '"pending"', "notified_volunteers": "[]"})
+    await backend.put_service("s1", {"status": '"accepted"'})
+    assert await backend.service("s1") == {"status": '"accepted"', "notified_volunteers": "[]"}
+    assert await backend.services() == {"s1": {"status": '"accepted"', "notified_volunteers": "[]"}}
+    assert await backend.service("s2") is None
+
+
+async def test_claim_is_first_wins_until_the_service_is_deleted(backend):
+    await backend.put_service("s1", {"status": '"pending"'})
+    assert await backend.claim_service("s1", "v1@x.com")
+    assert not await backend.claim_service("s1", "v2@x.com")
+    await backend.delete_service("s1")
+    assert await backend.service("s1") is None and await backend.services() == {}
+    assert await backend.claim_service("s1", "v2@x.com")
+
+
+async def test_publish_reaches_subscribers_of_that_channel(backend):
+    events = backend.subscribe("services", "presence")
+    received = asyncio.ensure_future(events.__anext__())
+    await asyncio.sleep(0.05)  # let the subscription start
+    await backend.publish("other", "ignored")
+    await backend.publish("presence", "hello")
+    assert await asyncio.wait_for(received, 1) == ("presence", "hello")
+    await events.aclose()
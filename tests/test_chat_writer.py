@@ -0,0 +1,120 @@
+import os
+import pytest
+from sqlalchemy import func, select
+from chat_writer import ChatWriter
+from db_init import ChatMessage
+from encoding import encode
+from model import ChatStatus
+
+pytestmark = pytest.mark.anyio
+
+
+def message(message_id, content="hi"):
+    return {"content": content, "service_id": "s1", "sender": "elder@x.com", "reciever": "vol@x.com",
+            "timestamp": "2099-01-01T00:00:00", "status": ChatStatus.sent, "message_id": message_id}
+
+
+def writer(db, tmp_path, node="n1"):
+    return ChatWriter(db, str(tmp_path / "journal"), node, batch_size=10, flush_interval=0.1)
+
+
+async def stored(db):
+    async with db.session_factory() as session:
+        rows = (await session.execute(select(ChatMessage.message_id, ChatMessage.status)
+                                      .order_by(ChatMessage.id))).all()
+    return [tuple(row) for row in rows]
+
+
+async def test_replayed_journal_skips_rows_already_stored(db, tmp_path):
+    # the worker died after committing the batch but before removing its .flushing file
+    rows = [db.chat_row(message("m1")), db.chat_row(message("m2"))]
+    async with db.session_factory() as session:
+        await db.add_messages(session, rows[:1])
+    os.makedirs(tmp_path / "journal")
+    with open(tmp_path / "journal" / "dead.flushing", "w") as journal:
+        journal.writelines(encode(row) + "\n" for row in rows)
+
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    assert [message_id for message_id, _ in await stored(db)] == ["m1", "m2"]
+    assert chat_writer.replayed == 2 and not os.path.exists(tmp_path / "journal" / "dead.flushing")
+    await chat_writer.close()
+
+
+async def test_flush_stores_the_batch_and_removes_the_journal(db, tmp_path):
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    chat_writer.add(message("m1"))
+    chat_writer.add(message("m2"))
+    assert await chat_writer.flush()
+    assert await stored(db) == [("m1", ChatStatus.sent), ("m2", ChatStatus.sent)]
+    assert chat_writer.stats()["queued"] == 0 and chat_writer.flushed == 2
+    assert not os.path.exists(tmp_path / "journal" / "n1.flushing")
+    await chat_writer.close()
+    assert os.listdir(tmp_path / "journal") == []
+
+
+async def test_bad_row_is_dead_lettered_and_does_not_block_the_batch(db, tmp_path):
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    chat_writer.add(message("bad", content=None))
+    chat_writer.add(message("good"))
+    assert await chat_writer.flush()
+    assert await stored(db) == [("good", ChatStatus.sent)]
+    assert chat_writer.stats()["queued"] == 0 and chat_writer.flushed == 1 and chat_writer.dead == 1
+    with open(tmp_path / "journal" / "n1.dead") as dead:
+        assert [line for line in dead if '"bad"' in line]
+    await chat_writer.close()
+
+
+async def test_unreachable_database_keeps_the_batch(db, tmp_path, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    async def unreachable(session, rows):
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    chat_writer.add(message("m1"))
+    monkeypatch.setattr(db, "add_messages", unreachable)
+    assert not await chat_writer.flush()
+    assert chat_writer.stats()["queued"] == 1 and chat_writer.dead == 0
+    assert os.path.exists(tmp_path / "journal" / "n1.flushing")
+    monkeypatch.undo()
+    assert await chat_writer.flush()
+    assert await stored(db) == [("m1", ChatStatus.sent)]
+    await chat_writer.close()
+
+
+async def test_recover_replays_dead_workers_only(db, tmp_path):
+    live = writer(db, tmp_path, "live")
+    await live.start()
+    live.add(message("live1"))
+    dead_row = db.chat_row(message("dead1"))
+    with open(tmp_path / "journal" / "dead.journal", "w") as journal:
+        journal.write(encode(dead_row) + "\n" + '{"torn')
+
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    assert await stored(db) == [("dead1", ChatStatus.sent)] and chat_writer.replayed == 1
+    assert not os.path.exists(tmp_path / "journal" / "dead.journal")
+    assert os.path.exists(tmp_path / "journal" / "live.journal")
+    await chat_writer.close()
+    await live.close()
+
+
+async def test_acks_mark_buffered_and_stored_rows_delivered(db, tmp_path):
+    chat_writer = writer(db, tmp_path)
+    await chat_writer.start()
+    chat_writer.add(message("stored"))
+    await chat_writer.flush()
+    chat_writer.add(message("buffered"))
+    chat_writer.add(message("other"))
+    chat_writer.ack("vol@x.com", ["stored", "buffered"])
+    chat_writer.ack("elder@x.com", ["other"])  # only the receiver acks a message
+    assert chat_writer.stats()["acks"] == 1
+    await chat_writer.flush()
+    assert await stored(db) == [("stored", ChatStatus.delivered), ("buffered", ChatStatus.delivered),
+                                ("other", ChatStatus.sent)]
+    assert chat_writer.stats()["acks"] == 0
+    await chat_writer.close()
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from model import ServiceStatus
+from service_store import ServiceStore
+
+
+def service(timeout_end, status=ServiceStatus.PENDING):
+    return {"status": status, "timeout_end": str(timeout_end), "notified_volunteers": []}
+
+
+def test_naive_and_aware_deadlines_mix():
+    store = ServiceStore()
+    store.add("naive", service(datetime(2099, 1, 1)))
+    store.add("aware", service(datetime(2099, 1, 1, tzinfo=timezone.utc)))
+    store.add("past", service(datetime.now(timezone.utc) - timedelta(seconds=1)))
+    assert store.stats() == {"pending": 3}
+    assert sorted(service_id for service_id, _ in store.pending()) == ["aware", "naive"]
+    assert store.expire() == ["past"]
+
+
+def test_bad_timeout_end_leaves_store_untouched():
+    store = ServiceStore()
+    with pytest.raises(ValueError):
+        store.add("bad", {"status": ServiceStatus.PENDING, "timeout_end": "tomorrow"})
+    assert len(store) == 0 and store.stats() == {} and store.dirty == {} and store.expiry == []
+
+
+def test_expire_skips_accepted_and_stale_entries():
+    store = ServiceStore()
+    past = datetime.now() - timedelta(seconds=1)
+    store.add("accepted", service(past))
+    store.update("accepted", status=ServiceStatus.ACCEPTED)
+    store.add("pending", service(past))
+    store.add("pending", service(datetime.now() + timedelta(hours=1)))  # moved deadline
+    assert store.expire() == []
+    assert store.stats() == {"accepted": 1, "pending": 1}
+
+
+def test_evict_finished_waits_until_persisted():
+    store = ServiceStore()
+    store.add("done", service(datetime(2099, 1, 1)))
+    store.update("done", status=ServiceStatus.COMPLETED)
+    assert store.evict_finished(["done"]) == []  # still dirty
+    assert store.take_changes() == {"done": {"status", "timeout_end", "notified_volunteers"}}
+    assert store.evict_finished(["done"]) == ["done"]
+    assert "done" not in store and store.stats() == {}
+
+
+def test_apply_takes_remote_copies_without_marking_them():
+    store = ServiceStore()
+    store.apply("remote", service("2099-01-01 00:00:00+05:30"))
+    assert store.dirty == {} and [service_id for service_id, _ in store.pending()] == ["remote"]
+    store.apply("remote", None)
+    assert len(store) == 0 and store.stats() == {}
+
+
+def test_restored_changes_are_taken_again():
+    store = ServiceStore()
+    store.add("done", service(datetime(2099, 1, 1)))
+    store.update("done", status=ServiceStatus.COMPLETED)
+    changes = store.take_changes()
+    store.restore_changes(changes)  # the save failed
+    assert store.changed.is_set() and store.evict_finished(["done"]) == []
+    assert store.take_changes() == changes
+
+
+def test_apply_fields_merges_into_held_services_only():
+    store = ServiceStore()
+    store.add("held", service(datetime(2099, 1, 1)))
+    store.take_changes()
+    assert store.apply_fields("held", {"status": ServiceStatus.ACCEPTED})
+    assert store["held"]["notified_volunteers"] == [] and store.stats() == {"accepted": 1}
+    assert not store.apply_fields("other", {"status": ServiceStatus.ACCEPTED})
+    assert "other" not in store and store.dirty == {}
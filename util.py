@@ -1,17 +1,59 @@
 from math import radians, sin, cos, sqrt, atan2
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
 
 class Util:
+    def parse_location(location: str):
+        lat, lon = location.split(",")
+        return float(lat), float(lon)
+
     def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float):
-        R = 6371.0
+        R = EARTH_RADIUS_KM
         lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        
+
         dlat = lat2 - lat1
         dlon = lon2 - lon1
-        
+
         # Haversine formula
         a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
         c = 2 * atan2(sqrt(a), sqrt(1-a))
-        
+
         distance_km = R * c
 
-        return distance_km
\ No newline at end of file
+        return distance_km
+
+    def calculate_distances(lat, lon, lats, lons) -> np.ndarray:
+        """Haversine distances in km in one vectorized pass.
+
+        ``lat``/``lon`` is one origin (scalars, result shape ``(n,)``) or ``m`` origins
+        (arrays, result shape ``(m, n)``); ``lats``/``lons`` are the ``n`` targets.
+        """
+        lat1 = np.radians(np.asarray(lat, dtype=np.float64))[..., None]
+        lon1 = np.radians(np.asarray(lon, dtype=np.float64))[..., None]
+        lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+        lon2 = np.radians(np.asarray(lons, dtype=np.float64))
+
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def nearest_k(lat, lon, lats, lons, k: int):
+        """Indices and distances of the ``k`` closest targets, closest first.
+
+        Uses a partial sort (argpartition) so only the selected ``k`` get ordered.
+        With many origins both results have shape ``(m, k)``.
+        """
+        distances = Util.calculate_distances(lat, lon, lats, lons)
+        n = distances.shape[-1]
+        k = min(k, n)
+        if k <= 0:
+            empty = np.empty(distances.shape[:-1] + (0,))
+            return empty.astype(np.intp), empty
+        if k < n:
+            idx = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+        else:
+            idx = np.broadcast_to(np.arange(n), distances.shape).copy()
+        top = np.take_along_axis(distances, idx, axis=-1)
+        order = np.argsort(top, axis=-1)
+        return np.take_along_axis(idx, order, axis=-1), np.take_along_axis(top, order, axis=-1)